@@ -19,6 +19,7 @@ import copy
 import json
 import logging
 import random
+import warnings
 import numpy as np
 from itertools import combinations
 
@@ -28,28 +29,78 @@ from nni.tuner import Tuner
 from nni.utils import extract_scalar_reward, OptimizeMode
 
 from const import FeatureType, AGGREGATE_TYPE
+from feature_space import FeatureSpace
+from cost_model import CostModel
+from profiler import Profiler, write_log
+from importance import space_version, unpack_importance
+from dispatch import NodeDispatcher
 
 logger = logging.getLogger('autofe-tuner')
 
 
 class AutoFETuner(Tuner):
-    def __init__(self, optimize_mode = 'maximize', feature_percent = 0.6):
+    def __init__(self, optimize_mode = 'maximize', feature_percent = 0.6, max_rung = 0, eta = 3, batch_size = 1, profile_log = None, time_budget = None, importance_decay = 0.5, nodes = None, node_slots = 2, negative_rate = None, bootstrap_fraction = None):
         """Initlization function
         count : 
         optimize_mode : contains "Maximize" or "Minimize" mode.
         search_space : define which features that tuner need to search
         feature_percent : @mengjiao
         default_space : @mengjiao 
-        epoch_importance : @mengjiao
-        estimate_sample_prob : @mengjiao
+        raw_importance : importance of the raw columns, from the first trial.
+        estimate_sample_prob : importance of every candidate, an exponential moving
+            average of the scores of the trials that sampled it.
+        importance_count : trials that reported the importance of every candidate.
+        max_rung : successive halving rungs, 0 trains every feature set with the full budget.
+            A new feature set starts at rung 0 with fidelity eta ** -max_rung (fraction of the
+            rows and of the boosting rounds), the top 1 / eta of every rung is promoted to the
+            next one, up to the full budget at max_rung. The trials raise a smaller
+            fraction to keep at least min_data (see model.params_lgb) rows per class.
+        eta : successive halving reduction factor.
+        batch_size : feature sets evaluated by one trial, the trial generates
+            the union of their features once and trains one model per set.
+        profile_log : optional JSONL file, gets the timings of generate_parameters
+            and receive_trial_result, the trials log theirs in the same format.
+        time_budget : optional seconds to generate and train on the sampled features
+            of a trial. The features are then sampled by importance per second
+            estimated by a CostModel learned from the trial profiles, until the
+            budget is spent. The training on the raw columns is reserved first.
+        importance_decay : weight of the last trial in the moving average of the
+            importance of a candidate, 1 keeps the last score only.
+        nodes : optional 'host:port' of node workers (main.py --worker --node), every
+            trial is sent to the node with a free slot whose feature cache holds most
+            of its sampled features, see NodeDispatcher.
+        node_slots : trials run by a node at once.
+        negative_rate : optional fraction of the negative train rows kept (and
+            reweighted) by the trials screening importance: the first trial and the
+            rungs below max_rung. The feature sets promoted to max_rung are
+            re-validated on all the rows.
+        bootstrap_fraction : optional stratified fraction of the rows (and of the
+            boosting rounds) the first trial seeds the raw importance on.
         """
         self.count = -1
         self.optimize_mode = OptimizeMode(optimize_mode)
-        self.search_space = None
+        self.raw_importance = None
         self.feature_percent = feature_percent
         self.default_space = []
-        self.epoch_importance = []
+        self.space_version = None
         self.estimate_sample_prob = None
+        self.importance_count = None
+        self.importance_decay = importance_decay
+        self.max_rung = max_rung
+        self.eta = eta
+        # rung -> [(reward, parameters)] and the promoted feature sets, see promote()
+        self.rungs = [[] for _ in range(max_rung)]
+        self.promoted = [set() for _ in range(max_rung)]
+        self.promotion_queue = []
+        self.batch_size = batch_size
+        self.profile_log = profile_log
+        self.time_budget = time_budget
+        self.cost_model = None
+        self.nodes = nodes
+        self.node_slots = node_slots
+        self.dispatcher = None
+        self.negative_rate = negative_rate
+        self.bootstrap_fraction = bootstrap_fraction
 
         logger.debug('init aufo-fe done.')
 
@@ -58,21 +109,104 @@ class AutoFETuner(Tuner):
         """Returns a set of trial graph config, as a serializable object.
         parameter_id : int
         """
-        self.count += 1
-        if self.count == 0:
-            return {'sample_feature': []}
+        profiler = Profiler(parameter_id = parameter_id)
+        with profiler.stage('generate_parameters'):
+            self.count += 1
+            if self.count == 0:
+                r = {'sample_feature': [], 'space_version': self.space_version}
+                # the raw importance only ranks the candidates, a sample is enough
+                if self.bootstrap_fraction is not None:
+                    r['fidelity'] = self.bootstrap_fraction
+                if self.negative_rate is not None:
+                    r['negative_rate'] = self.negative_rate
+            elif self.batch_size > 1:
+                r = {'sample_batch': [self.generate_feature_set() for _ in range(self.batch_size)]}
+            else:
+                r = self.generate_feature_set()
+            if self.dispatcher is not None:
+                r['node'] = self.dispatcher.assign(parameter_id, self.sampled_candidates(r))
+        self.log_profile(profiler)
+        return r
+
+
+    def sampled_candidates(self, parameters):
+        """
+        candidate indexes generated by a trial, over all its feature sets.
+        """
+        batch = parameters.get('sample_batch', [parameters])
+        return np.unique([i for p in batch for i in p.get('sample_index', [])]).astype(np.int64)
+
+
+    def generate_feature_set(self):
+        """
+        one sampled feature set, or a promoted one in successive halving.
+        """
+        if self.promotion_queue:
+            r = self.promotion_queue.pop(0)
         else:
-            sample_p = np.array(self.estimate_sample_prob) / np.sum(self.estimate_sample_prob)
+            sample_p = self.estimate_sample_prob / np.sum(self.estimate_sample_prob)
             sample_size = min(128, int(len(self.candidate_feature) * self.feature_percent))
-            sample_feature = np.random.choice(
-                self.candidate_feature, 
-                size = sample_size, 
-                p = sample_p, 
-                replace = False
-                )
-            gen_feature = list(sample_feature)
-            r = {'sample_feature': gen_feature}
-            return r  
+            fidelity = self.fidelity(0) if self.max_rung > 0 else {}
+            if self.time_budget is not None and self.cost_model.ready():
+                sample_index = self.sample_under_budget(sample_p, sample_size, fidelity.get('fidelity', 1.0))
+            else:
+                sample_index = np.random.choice(
+                    len(self.candidate_feature), 
+                    size = sample_size, 
+                    p = sample_p, 
+                    replace = False
+                    )
+            gen_feature = [self.candidate_feature.name(i) for i in sample_index]
+            r = {'sample_feature': gen_feature, 'sample_index': [int(i) for i in sample_index]}
+            r.update(fidelity)
+        # the trial echoes it in its importance payload
+        r['space_version'] = self.space_version
+        return r
+
+
+    def sample_under_budget(self, sample_p, sample_size, fidelity):
+        """
+        sample up to sample_size candidates without replacement, weighted by
+        importance per estimated second, while their cost fits in time_budget.
+        """
+        cost = self.cost_model.candidate_cost(fidelity, self.generated)
+        budget = self.time_budget - self.cost_model.raw_cost(fidelity)
+        weight = sample_p / cost
+        # Efraimidis-Spirakis keys, the top sample_size keys are a weighted sample
+        with np.errstate(divide='ignore'):
+            key = np.log(np.random.random_sample(len(weight))) / weight
+        order = np.argsort(-key)[:sample_size]
+        keep = np.cumsum(cost[order]) <= budget
+        # at least one feature, even over budget
+        keep[0] = True
+        return order[keep]
+
+
+    def fidelity(self, rung):
+        r = {'rung': rung, 'fidelity': float(self.eta) ** (rung - self.max_rung)}
+        if self.negative_rate is not None and rung < self.max_rung:
+            r['negative_rate'] = self.negative_rate
+        return r
+
+
+    def promote(self, parameters, reward):
+        """
+        asynchronous successive halving, record the reward of a feature set
+        on its rung and queue every feature set in the top 1 / eta of the
+        rung, that is not promoted yet, for the next rung.
+        """
+        rung = parameters['rung']
+        if rung >= self.max_rung:
+            return
+        self.rungs[rung].append((reward, parameters))
+        top = sorted(self.rungs[rung], key=lambda x: x[0], reverse=True)
+        for _, p in top[:len(top) // self.eta]:
+            key = tuple(p['sample_index'])
+            if key not in self.promoted[rung]:
+                self.promoted[rung].add(key)
+                r = {'sample_feature': p['sample_feature'], 'sample_index': p['sample_index']}
+                r.update(self.fidelity(rung + 1))
+                self.promotion_queue.append(r)
 
 
     def receive_trial_result(self, parameter_id, parameters, value, **kwargs):
@@ -82,18 +216,38 @@ class AutoFETuner(Tuner):
         parameters : dict of parameters
         value: final metrics of the trial
         '''
-        # get the default feature importance
+        if isinstance(value, dict) and 'profile' in value and self.cost_model is not None:
+            sampled = self.sampled_candidates(parameters)
+            self.cost_model.update(value['profile'], raw = 'sample_batch' not in parameters and len(sampled) == 0)
+            self.generated[sampled] = True
+        if isinstance(value, dict) and 'node' in value and self.dispatcher is not None:
+            # the node that ran the trial has its features in cache now
+            self.dispatcher.record(value['node'], self.sampled_candidates(parameters))
+        if 'sample_batch' in parameters:
+            # one result per feature set of a batched trial
+            for p, v in zip(parameters['sample_batch'], value['batch']):
+                self.receive_trial_result(parameter_id, p, v, **kwargs)
+            return
 
-        if self.search_space is None:
-            self.search_space = value['feature_importance']
-            self.estimate_sample_prob = self.estimate_candidate_probility()
-        else:
-            self.epoch_importance.append(value['feature_importance'])
-            # TODO
-            self.update_candidate_probility()
+        profiler = Profiler(parameter_id = parameter_id)
+        with profiler.stage('receive_trial_result'):
+            version, raw_score, index, score = unpack_importance(value['importance'])
+            if version != self.space_version:
+                # computed for the candidates of another search space
+                logger.warning('importance of search space %s ignored, the search space is %s', version, self.space_version)
+            elif raw_score is not None:
+                # get the default feature importance
+                if self.raw_importance is None:
+                    self.raw_importance = raw_score
+                    self.estimate_sample_prob = self.estimate_candidate_probility()
+            else:
+                self.update_candidate_probility(index, score)
+        self.log_profile(profiler)
         reward = extract_scalar_reward(value)
         if self.optimize_mode is OptimizeMode.Minimize:
             reward = -reward
+        if 'rung' in parameters:
+            self.promote(parameters, reward)
 
         logger.info('receive trial result is:\n')
         logger.info(str(parameters))
@@ -101,6 +255,16 @@ class AutoFETuner(Tuner):
         return
 
 
+    def trial_end(self, parameter_id, success, **kwargs):
+        if self.dispatcher is not None:
+            self.dispatcher.release(parameter_id)
+
+
+    def log_profile(self, profiler):
+        if self.profile_log is not None:
+            write_log(self.profile_log, profiler.records, process = 'tuner')
+
+
     def update_search_space(self, data):
         '''
         Input: data, search space object.
@@ -112,98 +276,60 @@ class AutoFETuner(Tuner):
         '''
 
         self.default_space = data
+        self.space_version = space_version(data)
         self.candidate_feature = self.json2space(data)
+        self.cost_model = CostModel(self.candidate_feature)
+        # candidates generated by a trial, read from the feature cache since
+        self.generated = np.zeros(len(self.candidate_feature), dtype=bool)
+        self.importance_count = np.zeros(len(self.candidate_feature), dtype=np.int32)
+        if self.nodes:
+            self.dispatcher = NodeDispatcher(self.nodes, len(self.candidate_feature), self.node_slots)
 
 
-    def update_candidate_probility(self):
+    def update_candidate_probility(self, index, score):
         """
         Using true_imp score to modify candidate probility.
+        index : the sampled candidates of a trial.
+        score : their importance in the trial, the sum over the columns a candidate generates.
         """
-        # get last importance
-        last_epoch_importance = self.epoch_importance[-1]
-        last_sample_feature = list(last_epoch_importance.feature_name)
-        for index, f in enumerate(self.candidate_feature):
-            if f in last_sample_feature:
-                score = max(float(last_epoch_importance[last_epoch_importance.feature_name == f]['feature_score']), 0.00001)
-                self.estimate_sample_prob[index] = score
-        
-        logger.debug("Debug UPDATE ", self.estimate_sample_prob)
+        score = np.nan_to_num(score, nan=0.0)
+        if not np.sum(score) > 0:
+            # the model of the trial made no split, its scores say nothing
+            logger.warning('trial without feature importance ignored')
+            return
+        score = np.maximum(score, 0.00001)
+        seen = self.importance_count[index] > 0
+        # moving average over the trials, the first score replaces the estimate from the raw columns
+        average = (1 - self.importance_decay) * self.estimate_sample_prob[index] + self.importance_decay * score
+        self.estimate_sample_prob[index] = np.where(seen, average, score)
+        self.importance_count[index] += 1
+
+        logger.debug("Debug UPDATE %s", self.estimate_sample_prob)
 
 
     def estimate_candidate_probility(self):
         """
         estimate_candidate_probility use history feature importance, first run importance.
         """
-        raw_score_dict = self.impdf2dict()
-        logger.debug("DEBUG feature importance\n", raw_score_dict)
+        logger.debug("DEBUG feature importance\n", self.raw_importance)
 
+        raw_score = np.array([self.raw_importance.get(i, np.nan) for i in self.candidate_feature.columns])
         gen_prob = []
-        for i in self.candidate_feature:
-            _feature = i.split('_')
-            score = [raw_score_dict[i] for i in _feature if i in raw_score_dict.keys()]
-            if len(score) == 1:
-                gen_prob.append(np.mean(score))
-            else:
-                generate_score = np.mean(score) * 0.9 # TODO
-                gen_prob.append(generate_score)
-        return gen_prob
-
-
-    def impdf2dict(self):
-        return dict([(i,j) for i,j in zip(self.search_space.feature_name, self.search_space.feature_score)])
+        for _, cols, _ in self.candidate_feature.blocks:
+            score = raw_score[cols]
+            found = np.sum(~np.isnan(score), axis=1)
+            with np.errstate(invalid='ignore'), warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                mean = np.nanmean(score, axis=1)
+            gen_prob.append(np.where(found == 1, mean, mean * 0.9)) # TODO
+        gen_prob = np.concatenate(gen_prob) if gen_prob else np.zeros(0)
+        # candidates without any scored column, or only zero scores, e.g. a
+        # first trial without any split, keep a small chance
+        return np.maximum(np.nan_to_num(gen_prob, nan=0.00001), 0.00001)
 
 
     def json2space(self, default_space):
         """
         parse json to search_space 
         """
-        result = []
-        for key in default_space.keys():
-            if key == FeatureType.COUNT:
-                for i in default_space[key]:
-                    name = (FeatureType.COUNT + '_{}').format(i)
-                    result.append(name)         
-            
-            elif key == FeatureType.CROSSCOUNT:
-                for i in default_space[key][0]:
-                    for j in default_space[key][1]:
-                        if i == j:
-                            continue
-                        cross = [i,j] 
-                        cross.sort()
-                        name = (FeatureType.CROSSCOUNT + '_') + '_'.join(cross)
-                        result.append(name)         
-                        
-            
-            elif key == FeatureType.AGGREGATE:
-                for i in default_space[key][0]:
-                    for j in default_space[key][1]:
-                        for stat in AGGREGATE_TYPE:
-                            name = (FeatureType.AGGREGATE + '_{}_{}_{}').format(stat, i, j)
-                            result.append(name)
-            
-            elif key == FeatureType.NUNIQUE:
-                for i in default_space[key][0]:
-                    for j in default_space[key][1]:
-                        name = (FeatureType.NUNIQUE + '_{}_{}').format(i, j)
-                        result.append(name)
-            
-            elif key == FeatureType.HISTSTAT:
-                for i in default_space[key][0]:
-                    for j in default_space[key][1]:
-                        name = (FeatureType.HISTSTAT + '_{}_{}').format(i, j)
-                        result.append(name)
-            
-            elif key == FeatureType.TARGET:
-                for i in default_space[key]:
-                    name = (FeatureType.TARGET + '_{}').format(i)
-                    result.append(name) 
-            
-            elif key == FeatureType.EMBEDDING:
-                for i in default_space[key]:
-                    name = (FeatureType.EMBEDDING + '_{}').format(i)
-                    result.append(name) 
-            
-            else:
-                raise RuntimeError('feature ' + str(key) + ' Not supported now')
-        return result
\ No newline at end of file
+        return FeatureSpace(default_space)
@@ -15,48 +15,53 @@
 # DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
 import nni
-import logging
-import numpy as np
-import pandas as pd
-import json
 import sys
-from sklearn.preprocessing import LabelEncoder
-
+import logging
 sys.path.append('../../')
 
-from fe_util import *
-from model import *
+import trial_worker
 
 logger = logging.getLogger('auto-fe-examples')
 
-if __name__ == '__main__':
-    file_name = ' ~/Downloads/breast-cancer.data'
-    target_name = 'Class'
-    id_index = 'Id'
-
-    # get parameters from tuner
-    RECEIVED_PARAMS = nni.get_next_parameter()
-    logger.info("Received params:\n", RECEIVED_PARAMS)
-    
-    # list is a column_name generate from tuner
-    df = pd.read_csv(file_name, sep = ',')
+file_name = ' ~/Downloads/breast-cancer.data'
+target_name = 'Class'
+id_index = 'Id'
+# keep the modules and the data loaded in a worker process between trials
+use_worker = True
+
+
+def load_data():
+    from data_util import load_dataset, file_key
+    from sklearn.preprocessing import LabelEncoder
+
+    df = load_dataset(file_name, sep = ',')
     df.columns = [
         'Class', 'age', 'menopause', 'tumor-size', 'inv-nodes',
         'node-caps', 'deg-malig', 'breast', 'breast-quad', 'irradiat'
     ]
     df['Class'] = LabelEncoder().fit_transform(df['Class'])
-    
-    if 'sample_feature' in RECEIVED_PARAMS.keys():
-        sample_col = RECEIVED_PARAMS['sample_feature']
+    # the feature caches are keyed by the source file and its read options
+    return df, file_key(os.path.expanduser(file_name), {'sep': ','})
+
+
+def run_trial(data, RECEIVED_PARAMS, report=None):
+    from trial_util import run_batch
+
+    df, fingerprint = data
+    return run_batch(df, RECEIVED_PARAMS, fingerprint, target_name, id_index, report = report)
+
+
+if __name__ == '__main__':
+    if '--worker' in sys.argv:
+        trial_worker.serve(__file__, load_data, run_trial, data_files = [file_name])
     else:
-        sample_col = []
-    
-    # raw feaure + sample_feature
-    df = name2feature(df, sample_col, target_name)
-    feature_imp, val_score = lgb_model_train(df,  _epoch = 1000, target_name = target_name, id_index = id_index)
-    nni.report_final_result({
-        "default":val_score, 
-        "feature_importance":feature_imp
-    })
+        # get parameters from tuner
+        RECEIVED_PARAMS = nni.get_next_parameter()
+        logger.info("Received params:\n", RECEIVED_PARAMS)
 
+        result = trial_worker.run(
+            __file__, load_data, run_trial, RECEIVED_PARAMS,
+            data_files = [file_name], use_worker = use_worker)
+        nni.report_final_result(result)
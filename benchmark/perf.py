@@ -0,0 +1,249 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from const import FeatureType
+from fe_util import KeyCache, OP_REGISTRY, name2feature
+from model import lgb_model_train
+from profiler import Profiler, peak_rss
+
+# operator -> (args, kwargs) on a synthetic table
+OPERATORS = [
+    (FeatureType.COUNT, ['c0'], {}),
+    (FeatureType.CROSSCOUNT, [['c0', 'c1']], {}),
+    (FeatureType.AGGREGATE, ['n0', 'c0'], {}),
+    (FeatureType.NUNIQUE, ['c1', 'c0'], {}),
+    (FeatureType.HISTSTAT, ['c1', 'c0'], {}),
+    (FeatureType.TARGET, ['c0'], {'target_name': 'Label'}),
+    (FeatureType.EMBEDDING, ['m0'], {}),
+]
+
+# feature set of the end to end trial
+TRIAL_FEATURES = [
+    'count_c0', 'count_c1', 'crosscount_c0_c1', 'aggregate_mean_n0_c0', 'aggregate_max_n1_c1',
+    'nunique_c1_c0', 'histstat_c1_c0', 'target_c0',
+]
+
+
+def skewed_codes(rng, n_rows, cardinality, skew):
+    """
+    n_rows draws of 0..cardinality-1 with p(k) ~ 1 / (k + 1) ** skew.
+    """
+    p = 1.0 / np.arange(1, cardinality + 1) ** skew
+    return rng.choice(cardinality, size=n_rows, p=p / p.sum())
+
+
+def join_tokens(tokens, codes, length):
+    """
+    one ' ' separated string of length[i] tokens per row, codes holds the
+    token codes of all the rows one after the other. Built one token
+    position at a time instead of one row at a time.
+    """
+    row = np.repeat(np.arange(len(length)), length)
+    position = np.arange(len(codes)) - np.repeat(np.cumsum(length) - length, length)
+    matrix = np.full((len(length), max(length.max(), 1)), -1)
+    matrix[row, position] = codes
+    result = tokens[matrix[:, 0]]
+    for j in range(1, matrix.shape[1]):
+        more = matrix[:, j] >= 0
+        result = np.where(more, np.char.add(np.char.add(result, ' '), tokens[matrix[:, j]]), result)
+    return result
+
+
+def make_table(n_rows, cardinality=1000, skew=1.0, n_num=2, n_cat=2, seed=2018, multi=True):
+    """
+    synthetic table: n_cat string columns c* of the given cardinality and
+    zipf skew, n_num float columns n*, one multi-category column m0 and a
+    binary Label depending on c0 and n0.
+    multi : build m0, only the embedding reads it. The tokens are drawn
+    anyway, so the other columns do not depend on it.
+    """
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame()
+    for i in range(n_cat):
+        codes = skewed_codes(rng, n_rows, cardinality, skew)
+        # categorical like the columns of a typed dataset, see data_util.load_dataset
+        df['c{}'.format(i)] = pd.Categorical.from_codes(codes, ['v{}'.format(k) for k in range(cardinality)])
+    for i in range(n_num):
+        values = rng.randn(n_rows)
+        values[rng.random_sample(n_rows) < 0.05] = np.nan
+        df['n{}'.format(i)] = values
+    tokens = np.array(['t{}'.format(k) for k in range(min(cardinality, 1000))])
+    length = rng.randint(1, 5, size=n_rows)
+    codes = skewed_codes(rng, int(length.sum()), len(tokens), skew)
+    if multi:
+        df['m0'] = join_tokens(tokens, codes, length)
+    logit = 0.5 * np.nan_to_num(df['n0'].values) + np.where(df['c0'].cat.codes.values == 0, 1.0, -0.2)
+    df['Label'] = (rng.random_sample(n_rows) < 1 / (1 + np.exp(-logit))).astype(np.int8)
+    return df
+
+
+def measure(func, repeat):
+    """
+    run func repeat times for the timings, and once more under tracemalloc
+    for the peak of the memory it allocates.
+    """
+    walls, cpus = [], []
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        func()
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'wall_min': min(walls), 'wall_median': float(np.median(walls)), 'cpu_median': float(np.median(cpus)),
+        'peak_alloc': peak, 'max_rss': peak_rss(),
+    }
+
+
+def bench_operator(df, op_name, args, kwargs, repeat):
+    func = OP_REGISTRY[op_name][0]
+    raw_columns = list(df.columns)
+
+    def run():
+        # a cold KeyCache, the factorization is part of the operator
+        if op_name == FeatureType.EMBEDDING:
+            func(df[raw_columns].copy(deep=False), *args, **kwargs)
+        else:
+            func(df[raw_columns].copy(deep=False), *args, keys=KeyCache(df), **kwargs)
+    return measure(run, repeat)
+
+
+def bench_trial(df, epoch):
+    """
+    end to end trial: generate TRIAL_FEATURES and train, timed per stage.
+    """
+    profiler = Profiler()
+    wall = time.perf_counter()
+    data = name2feature(df.copy(deep=False), list(TRIAL_FEATURES), 'Label', profiler=profiler)
+    lgb_model_train(data.drop(columns=['m0'], errors='ignore'), _epoch=epoch, target_name='Label', profiler=profiler)
+    stages = {}
+    for record in profiler.records:
+        stages[record['stage']] = stages.get(record['stage'], 0) + record['wall']
+    return {'wall_min': time.perf_counter() - wall, 'stages': stages, 'max_rss': peak_rss()}
+
+
+def run(args):
+    results = []
+    for n_rows in args.rows:
+        n_rows = int(float(n_rows))
+        for cardinality in args.cardinality:
+            multi = not args.ops or FeatureType.EMBEDDING in args.ops
+            df = make_table(n_rows, cardinality, args.skew, seed=args.seed, multi=multi)
+            case = {'rows': n_rows, 'cardinality': cardinality, 'skew': args.skew}
+            for op_name, op_args, kwargs in OPERATORS:
+                if args.ops and op_name not in args.ops:
+                    continue
+                result = dict(case, bench=op_name)
+                try:
+                    result.update(bench_operator(df, op_name, op_args, kwargs, args.repeat))
+                    result['rows_per_sec'] = n_rows / result['wall_min']
+                except ImportError as e:
+                    # e.g. embedding without gensim
+                    result['skipped'] = str(e)
+                results.append(result)
+                print(format_result(result), flush=True)
+            if args.trial:
+                result = dict(case, bench='trial')
+                result.update(bench_trial(df, args.epoch))
+                result['rows_per_sec'] = n_rows / result['wall_min']
+                results.append(result)
+                print(format_result(result), flush=True)
+    return results
+
+
+def format_result(result):
+    name = '{bench:<12}{rows:>12}{cardinality:>10}'.format(**result)
+    if 'skipped' in result:
+        return name + '  skipped: ' + result['skipped']
+    # the allocation peak of an operator, the process high-water mark of a trial
+    memory = result['peak_alloc'] if 'peak_alloc' in result else result['max_rss']
+    return name + '{:>12.4f}s{:>14.0f} rows/s{:>10.1f} MB'.format(
+        result['wall_min'], result['rows_per_sec'], (memory or 0) / 2 ** 20)
+
+
+def environment():
+    import lightgbm
+    return {
+        'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+        'numpy': np.__version__, 'pandas': pd.__version__, 'lightgbm': lightgbm.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    print the wall time ratio of every bench found in baseline, return the
+    ones slower than threshold times their baseline.
+    """
+    def key(r):
+        return (r['bench'], r['rows'], r['cardinality'], r['skew'])
+    base = dict((key(r), r) for r in baseline['results'] if 'wall_min' in r)
+    regressions = []
+    for result in results:
+        if 'wall_min' not in result or key(result) not in base:
+            continue
+        ratio = result['wall_min'] / base[key(result)]['wall_min']
+        print('{:<12}{:>12}{:>10}  x{:.2f}'.format(result['bench'], result['rows'], result['cardinality'], ratio))
+        if ratio > threshold:
+            regressions.append(result)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='throughput and memory of the fe_util operators and of a trial')
+    parser.add_argument('--rows', nargs='+', default=['1e4', '1e5', '1e6'], help='row counts, 1e4 to 1e8')
+    parser.add_argument('--cardinality', nargs='+', type=int, default=[100, 100000])
+    parser.add_argument('--skew', type=float, default=1.0, help='zipf exponent of the categories')
+    parser.add_argument('--ops', nargs='*', help='operators to run, all by default')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=2018)
+    parser.add_argument('--trial', action='store_true', help='also time an end to end trial')
+    parser.add_argument('--epoch', type=int, default=100, help='boosting rounds of the trial')
+    parser.add_argument('--output', default='perf_report.json')
+    parser.add_argument('--baseline', help='report to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown counted as a regression')
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'args': vars(args), 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print('{} regressions over x{}'.format(len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+
+# shortest time taken into account, in seconds
+MIN_SECONDS = 1e-6
+
+
+class CostModel:
+    """
+    seconds to generate and to train on each candidate of a FeatureSpace,
+    learned from the profile records reported by the trials.
+
+    The generation time of a feature is modeled in log space as
+    log(seconds) = op_cost[op] + mean(column_cost[cols]), fitted online by
+    one gradient step per 'feature' record. So a crosscount of two high
+    cardinality columns costs more than one of two small ones, and an op
+    or column never measured takes the average. A feature read from the
+    feature cache costs the seconds per hit of the 'cache_read' records
+    instead. The training time is the seconds per feature of the 'train'
+    records at full fidelity, the raw columns of the first trial are
+    trained in every trial on top of the sampled features.
+    """
+    def __init__(self, feature_space, learning_rate=0.2):
+        self.feature_space = feature_space
+        self.learning_rate = learning_rate
+        self.op_cost = {}
+        self.column_cost = np.zeros(len(feature_space.columns))
+        self.cached_cost = None
+        self.train_cost = None
+        self.raw_features = None
+
+
+    def ready(self):
+        return (len(self.op_cost) > 0 or self.cached_cost is not None) \
+            and self.train_cost is not None and self.raw_features is not None
+
+
+    def update(self, records, raw=False):
+        """
+        fit the 'feature', 'cache_read' and 'train' records of one trial profile.
+        raw : the trial trained on the raw columns only.
+        """
+        for record in records:
+            if record['stage'] == 'feature':
+                self.update_feature(record)
+            elif record['stage'] == 'cache_read' and record.get('hits'):
+                self.cached_cost = self.ema(self.cached_cost, record['wall'] / record['hits'])
+            elif record['stage'] == 'train' and record.get('features'):
+                # rows and boosting rounds both scale with the fidelity
+                seconds = record['wall'] / record['features'] / record.get('row_fraction', 1.0) ** 2
+                self.train_cost = self.ema(self.train_cost, seconds)
+                if raw:
+                    self.raw_features = record['features']
+
+
+    def update_feature(self, record):
+        cols = [self.feature_space.column_index[i] for i in record['columns']
+                if i in self.feature_space.column_index]
+        seconds = np.log(max(record['wall'] / record.get('features', 1), MIN_SECONDS))
+        op_name = record['op']
+        if op_name not in self.op_cost:
+            self.op_cost[op_name] = seconds - (np.mean(self.column_cost[cols]) if cols else 0)
+            return
+        error = seconds - self.op_cost[op_name] - (np.mean(self.column_cost[cols]) if cols else 0)
+        self.op_cost[op_name] += self.learning_rate * error
+        if cols:
+            self.column_cost[cols] += self.learning_rate * error
+
+
+    def ema(self, value, x):
+        return x if value is None else value + self.learning_rate * (x - value)
+
+
+    def generate_cost(self, cached=None):
+        """
+        estimated seconds to generate every candidate.
+        cached : optional bool array, the candidates in the feature cache.
+        """
+        cached_cost = self.cached_cost or 0.0
+        if len(self.op_cost) == 0:
+            # only cache hits so far, no operator timed yet
+            cost = np.full(len(self.feature_space), cached_cost)
+        else:
+            default = np.mean(list(self.op_cost.values()))
+            cost = []
+            for op_name, cols, _ in self.feature_space.blocks:
+                cost.append(self.op_cost.get(op_name, default) + np.mean(self.column_cost[cols], axis=1))
+            cost = np.exp(np.concatenate(cost)) if cost else np.zeros(0)
+        if cached is not None:
+            cost = np.where(cached, cached_cost, cost)
+        return cost
+
+
+    def candidate_cost(self, fidelity=1.0, cached=None):
+        """
+        estimated seconds to generate and train on every candidate at fidelity.
+        """
+        return self.generate_cost(cached) + fidelity ** 2 * self.train_cost
+
+
+    def raw_cost(self, fidelity=1.0):
+        """
+        estimated seconds to train on the raw columns at fidelity.
+        """
+        return fidelity ** 2 * self.train_cost * self.raw_features
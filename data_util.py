@@ -0,0 +1,128 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+def file_key(file_name, read_kwargs):
+    """
+    cache key of a raw file: path, size, mtime and the read options.
+    """
+    stat = os.stat(file_name)
+    h = hashlib.md5()
+    h.update(json.dumps([
+        os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns,
+        sorted((str(k), str(v)) for k, v in read_kwargs.items())]).encode('utf-8'))
+    return h.hexdigest()
+
+
+def downcast(series):
+    """
+    smallest lossless dtype of a column.
+
+    return (values, dictionary), dictionary is the sorted categories of a
+    string column encoded as int codes (-1 for missing), None otherwise.
+    """
+    if pd.api.types.is_bool_dtype(series):
+        return series.values, None
+    if pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast='integer').values, None
+    if pd.api.types.is_float_dtype(series):
+        values = series.values
+        small = values.astype(np.float32)
+        if np.array_equal(small, values, equal_nan=True):
+            return small, None
+        return values, None
+    series = series.where(series.isnull(), series.astype(str))
+    codes, uniques = pd.factorize(series, sort=True)
+    for dtype in [np.int8, np.int16, np.int32]:
+        if len(uniques) < np.iinfo(dtype).max:
+            break
+    return codes.astype(dtype), np.asarray(uniques, dtype='U')
+
+
+def build_dataset(df, path):
+    """
+    write df as one typed .npy per column under path.
+
+    Numeric columns get their smallest lossless dtype, string columns are
+    stored as int codes plus a dictionary file. The columns go to a temp
+    dir renamed into place at the end, so concurrent trials building the
+    same cache never see a partial one.
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    kinds = []
+    for i, col in enumerate(df.columns):
+        values, dictionary = downcast(df[col])
+        if dictionary is None:
+            kinds.append('num')
+        else:
+            kinds.append('cat')
+            np.save(os.path.join(tmp_path, '{}.dict.npy'.format(i)), dictionary, allow_pickle=False)
+        np.save(os.path.join(tmp_path, '{}.npy'.format(i)), values, allow_pickle=False)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'columns': [str(i) for i in df.columns], 'kinds': kinds}, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another trial won the race
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def open_dataset(path):
+    """
+    memory-map a dataset written by build_dataset read-only, string
+    columns come back as pandas categoricals over their memory-mapped
+    codes, so every trial of a worker shares the same pages.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    data = {}
+    for i, (col, kind) in enumerate(zip(meta['columns'], meta['kinds'])):
+        values = np.load(os.path.join(path, '{}.npy'.format(i)), mmap_mode='r')
+        if kind == 'cat':
+            dictionary = np.load(os.path.join(path, '{}.dict.npy'.format(i)))
+            # build_dataset wrote valid codes, validating them would scan the
+            # whole column and may give a copy instead of the memmap
+            dtype = pd.CategoricalDtype(dictionary.astype(object))
+            values = pd.Categorical.from_codes(values, dtype=dtype, validate=False)
+        data[col] = values
+    return pd.DataFrame(data, copy=False)
+
+
+def load_dataset(file_name, cache_dir='dataset_cache', **kwargs):
+    """
+    read a csv through a typed columnar binary cache.
+
+    The first trial parses and profiles the csv once and stores it column
+    by column, every later or concurrent trial memory-maps the columns
+    instead, so startup skips the csv parse and the pages are shared
+    between trials.
+    kwargs : passed to pd.read_csv
+    """
+    file_name = os.path.expanduser(file_name)
+    path = os.path.join(cache_dir, file_key(file_name, kwargs))
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        os.makedirs(cache_dir, exist_ok=True)
+        build_dataset(pd.read_csv(file_name, **kwargs), path)
+    return open_dataset(path)
@@ -0,0 +1,74 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import logging
+import numpy as np
+
+logger = logging.getLogger('autofe-dispatch')
+
+
+class NodeDispatcher:
+    """
+    locality aware placement of the trials on the node workers.
+
+    Every node keeps its own dataset and feature cache, a feature set is
+    sent to the node that already materialized most of its candidates,
+    among the nodes with a free slot. materialized[node, candidate] is
+    learnt from the results, a result names the node that ran it.
+    nodes : 'host:port' of the node workers, see trial_worker.serve.
+    n_candidates : number of candidates of the search space.
+    slots : trials run by a node at once before the less loaded nodes are preferred.
+    """
+    def __init__(self, nodes, n_candidates, slots=2):
+        self.nodes = list(nodes)
+        self.slots = slots
+        self.materialized = np.zeros((len(self.nodes), n_candidates), dtype=bool)
+        self.running = np.zeros(len(self.nodes), dtype=np.int64)
+        # trial -> node index, until trial_end
+        self.assigned = {}
+
+
+    def assign(self, trial_id, index):
+        """
+        pick the node of a trial sampling the candidates index.
+        """
+        hits = self.materialized[:, index].sum(axis=1)
+        free = self.running < self.slots
+        if not free.any():
+            free = self.running == self.running.min()
+        # most materialized candidates first, then the least loaded node
+        score = np.where(free, hits, -1)
+        best = np.flatnonzero(score == score.max())
+        node = best[np.argmin(self.running[best])]
+        self.running[node] += 1
+        self.assigned[trial_id] = node
+        logger.debug('trial %s on node %s, %d of %d candidates cached', trial_id, self.nodes[node], hits[node], len(index))
+        return self.nodes[node]
+
+
+    def record(self, node, index):
+        """
+        the candidates index are in the feature cache of node now.
+        """
+        if node in self.nodes:
+            self.materialized[self.nodes.index(node), index] = True
+
+
+    def release(self, trial_id):
+        node = self.assigned.pop(trial_id, None)
+        if node is not None:
+            self.running[node] -= 1
@@ -0,0 +1,209 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+import pandas as pd
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+from const import FeatureType
+from fe_util import GroupKey, KeyCache, ColumnBuffer, run_plan, call_columns
+from profiler import Profiler
+
+# column buffers attached by a worker process, name -> (SharedMemory, array)
+_shared = {}
+# process pools of this process, n_workers -> ProcessPoolExecutor
+_pools = {}
+
+
+def to_shared(array):
+    """
+    copy array into a new shared memory block, return (block, shared array).
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[:] = array
+    return shm, shared
+
+
+def share(array, blocks):
+    """
+    put array into shared memory, return its (name, dtype, shape) spec.
+    """
+    shm, shared = to_shared(array)
+    blocks.append(shm)
+    return shm.name, shared.dtype, shared.shape
+
+
+def attach(spec):
+    """
+    map a shared block described by (name, dtype, shape) read-only.
+    """
+    name, dtype, shape = spec
+    if name not in _shared:
+        shm = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        array.flags.writeable = False
+        _shared[name] = (shm, array)
+    return _shared[name][1]
+
+
+def detach(specs):
+    """
+    unmap the shared blocks of specs, once no array of them is referenced.
+    """
+    for name, _, _ in specs:
+        if name in _shared:
+            shm, _ = _shared.pop(name)
+            shm.close()
+
+
+def pool_context():
+    """
+    start method of the pool processes. A fork of a process running other
+    threads (e.g. a trial worker, lightgbm) can deadlock on a lock held by
+    one of them, the forkserver forks the workers from a clean server with
+    this module preloaded instead, spawn where there is no forkserver.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['fe_parallel'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def get_pool(n_workers):
+    """
+    the process pool of n_workers of this process, started once and kept
+    for the next plans, e.g. the next trials of a trial worker slot.
+    """
+    if n_workers not in _pools:
+        _pools[n_workers] = ProcessPoolExecutor(max_workers=n_workers, mp_context=pool_context())
+    return _pools[n_workers]
+
+
+def plan_columns(calls, target_name):
+    """
+    raw columns read by the calls of one plan group.
+    """
+    result = []
+    for op_name, args, _ in calls:
+        cols = call_columns(op_name, args)
+        if op_name == FeatureType.TARGET:
+            cols.append(target_name)
+        result += [i for i in cols if i not in result]
+    return result
+
+
+def run_group(key_cols, calls, target_name, columns):
+    """
+    worker side of one plan group.
+
+    columns : col -> (codes spec, n_groups, values spec or None), values are
+    shared for numeric columns only, other columns are seen as their codes.
+    return (output block name, output columns, profiler records)
+    """
+    try:
+        return generate_group(key_cols, calls, target_name, columns)
+    finally:
+        # the pool outlives the plan, its blocks are unlinked by the caller
+        detach([spec for codes_spec, _, values_spec in columns.values()
+                for spec in [codes_spec, values_spec] if spec is not None])
+
+
+def generate_group(key_cols, calls, target_name, columns):
+    data = {}
+    keys = KeyCache(None)
+    for col, (codes_spec, n_groups, values_spec) in columns.items():
+        codes = attach(codes_spec)
+        keys.keys[(col,)] = GroupKey(codes, n_groups)
+        if values_spec is not None:
+            data[col] = attach(values_spec)
+        else:
+            data[col] = np.where(codes >= 0, codes, np.nan)
+    df = pd.DataFrame(data)
+    raw_columns = list(df.columns)
+    profiler = Profiler()
+    df = run_plan(df, [(key_cols, calls)], target_name, keys, profiler)
+
+    output_columns = [i for i in df.columns if i not in raw_columns]
+    shm, _ = to_shared(np.vstack([df[i].values.astype(float) for i in output_columns]))
+    shm.close()
+    return shm.name, output_columns, profiler.records
+
+
+def run_plan_parallel(df, plan, target_name='label', n_workers=4, profiler=None, cache=None):
+    """
+    execute the independent plan groups on a process pool.
+
+    Raw columns are shipped to the workers once through shared memory as
+    int codes (plus the values of numeric columns) instead of pickling
+    the dataframe, every worker writes its outputs into a shared block that
+    is mapped back here. Groups without a key (embedding) run serially.
+    profiler : optional Profiler, gets the 'feature' records of the workers.
+    cache : optional FeatureCache passed on to the serial groups.
+    """
+    profiler = profiler or Profiler()
+    serial_plan = [i for i in plan if i[0] is None]
+    parallel_plan = [i for i in plan if i[0] is not None]
+
+    blocks = []
+    columns = {}
+    keys = KeyCache(df)
+    try:
+        for key_cols, calls in parallel_plan:
+            for col in plan_columns(calls, target_name):
+                if col in columns:
+                    continue
+                key = keys.get([col])
+                columns[col] = (share(key.codes, blocks), key.n_groups, None)
+                if pd.api.types.is_numeric_dtype(df[col]):
+                    columns[col] = columns[col][:2] + (share(df[col].values, blocks), )
+
+        pool = get_pool(n_workers)
+        try:
+            futures = []
+            for key_cols, calls in parallel_plan:
+                group_columns = dict((i, columns[i]) for i in plan_columns(calls, target_name))
+                futures.append(pool.submit(run_group, key_cols, calls, target_name, group_columns))
+            for future in futures:
+                name, output_columns, records = future.result()
+                # the cpu and memory of these records are the worker's
+                profiler.extend(records, parallel = True)
+                shm = shared_memory.SharedMemory(name=name)
+                try:
+                    result = np.ndarray((len(output_columns), len(df)), dtype=float, buffer=shm.buf)
+                    # pandas owns its column memory, this is the only copy,
+                    # a ColumnBuffer copies into its slot
+                    for i, col in enumerate(output_columns):
+                        df[col] = result[i] if isinstance(df, ColumnBuffer) else np.array(result[i])
+                    del result
+                finally:
+                    shm.close()
+                    shm.unlink()
+        except BrokenProcessPool:
+            # a worker died, the next plan starts a new pool
+            _pools.pop(n_workers, None)
+            raise
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return run_plan(df, serial_plan, target_name, profiler = profiler, cache = cache)
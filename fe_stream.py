@@ -0,0 +1,365 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+import pandas as pd
+
+from const import FeatureType, AGGREGATE_TYPE
+from fe_util import compile_plan, feature_columns, parse_feature
+
+
+def weighted_group_stats(groups, values, weights, stat_list):
+    """
+    per group statistics of values repeated weights times.
+
+    groups : key of every (value, weight) entry
+    return DataFrame indexed by the group key, one column per stat.
+    """
+    frame = pd.DataFrame({'group': groups, 'value': values, 'weight': weights})
+    frame = frame[frame['value'].notnull()].sort_values(['group', 'value'])
+    codes, uniques = pd.factorize(frame['group'], sort=False)
+    value = frame['value'].values.astype(float)
+    weight = frame['weight'].values.astype(float)
+
+    n = np.bincount(codes, weights=weight, minlength=len(uniques))
+    result = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(codes, weights=weight * value, minlength=len(uniques)) / n
+        square = np.bincount(codes, weights=weight * (value - mean[codes]) ** 2, minlength=len(uniques))
+        result['mean'] = mean
+        result['var'] = np.where(n > 1, square / (n - 1), np.nan)
+    # entries are sorted by (group, value), a group is one contiguous run
+    end = np.cumsum(np.bincount(codes, minlength=len(uniques)))
+    start = end - np.bincount(codes, minlength=len(uniques))
+    result['min'] = value[start]
+    result['max'] = value[end - 1]
+    # the k-th smallest row of a group is the first entry whose cumulative weight passes k
+    cum_weight = np.cumsum(weight)
+    offset = cum_weight[end - 1] - n
+    lo = np.searchsorted(cum_weight, offset + (n - 1) // 2, side='right')
+    hi = np.searchsorted(cum_weight, offset + n // 2, side='right')
+    result['median'] = (value[lo] + value[hi]) / 2
+
+    return pd.DataFrame(dict((i, result[i]) for i in stat_list), index=uniques)
+
+
+def merge_moments(a, b):
+    """
+    merge two per key (count, sum, m2, min, max) states, Chan's parallel variance.
+    """
+    if a is None:
+        return b
+    a, b = a.align(b, join='outer')
+    for i in ['count', 'sum', 'm2']:
+        a[i], b[i] = a[i].fillna(0), b[i].fillna(0)
+    n = a['count'] + b['count']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = b['sum'] / b['count'] - a['sum'] / a['count']
+        m2 = a['m2'] + b['m2'] + (delta ** 2 * a['count'] * b['count'] / n).fillna(0)
+    return pd.DataFrame({
+        'count': n,
+        'sum': a['sum'] + b['sum'],
+        'm2': m2,
+        'min': np.fmin(a['min'], b['min']),
+        'max': np.fmax(a['max'], b['max']),
+        })
+
+
+def add_counts(a, b):
+    if a is None:
+        return b
+    return a.add(b, fill_value=0)
+
+
+def hll_rank(hashed, precision):
+    """
+    HyperLogLog register and rank of 64 bit hashes, the top bits pick the
+    register, the rank is taken on the low 32 bits.
+    """
+    assert 4 <= precision <= 16
+    register = (hashed >> np.uint64(64 - precision)).astype(np.int64)
+    low = (hashed & np.uint64(0xffffffff)).astype(float)
+    with np.errstate(divide='ignore'):
+        rank = np.where(low > 0, 32 - np.floor(np.log2(low)), 33).astype(np.uint8)
+    return register, rank
+
+
+def hll_estimate(total, empty, m):
+    """
+    distinct counts of sketches of m registers, from the sum of 2 ** -register
+    and the number of empty registers of every sketch.
+    """
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+    estimate = alpha * m * m / total
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(empty, 1))
+    return np.where((estimate <= 2.5 * m) & (empty > 0), linear, estimate)
+
+
+def max_registers(cells, ranks):
+    """
+    the max rank of every distinct cell, return (sorted cells, ranks).
+    """
+    order = np.argsort(cells, kind='stable')
+    cells, ranks = cells[order], ranks[order]
+    first = np.ones(len(cells), dtype=bool)
+    first[1:] = cells[1:] != cells[:-1]
+    start = np.flatnonzero(first)
+    if len(start) == 0:
+        return cells, ranks
+    return cells[start], np.maximum.reduceat(ranks, start)
+
+
+def lookup(table, chunk, cols):
+    """
+    look up per key values of table for every row of chunk.
+    """
+    if len(cols) == 1:
+        return table.reindex(chunk[cols[0]].values).values
+    return table.reindex(pd.MultiIndex.from_frame(chunk[list(cols)])).values
+
+
+class StreamFeatureBuilder:
+    """
+    out of core feature generation in two passes over the data.
+
+    partial_fit accumulates compact per key state chunk by chunk (counts,
+    sums, m2, min/max, distinct pairs), transform then emits the feature
+    columns for a chunk. Peak memory is bounded by the key cardinality
+    instead of the row count, except aggregate median, histstat and the
+    exact nunique: they keep (key, value) pairs, bounded by the distinct
+    pairs only.
+    nunique_precision : optional HyperLogLog precision, nunique then keeps
+    the hit registers of 2 ** precision per key instead of the pairs, at
+    most one per distinct pair and per register, and counts approximately,
+    the relative standard error is 1.04 / sqrt(2 ** precision), 1.6% for
+    precision 12.
+    target and embedding need the whole column and are not supported.
+    """
+    def __init__(self, feature_space, nunique_precision=None):
+        self.nunique_precision = nunique_precision
+        self.calls = []
+        for key_cols, calls in compile_plan(feature_space):
+            for op_name, args, stat_list in calls:
+                if op_name in [FeatureType.TARGET, FeatureType.EMBEDDING]:
+                    raise RuntimeError('Do not support this OP in streaming mode: ' + str(op_name))
+                if op_name == FeatureType.CROSSCOUNT:
+                    args = args[0]
+                self.calls.append((op_name, tuple(args), tuple(stat_list or AGGREGATE_TYPE)))
+        self.state = {}
+        self.tables = None
+
+
+    def key_columns(self):
+        """
+        columns used as group by keys, read them as str so that every chunk agrees on the dtype.
+        """
+        result = set()
+        for op_name, args, _ in self.calls:
+            if op_name == FeatureType.AGGREGATE:
+                result.add(args[1])
+            else:
+                result.update(args)
+        return sorted(result)
+
+
+    def value_columns(self):
+        """
+        numeric columns of the aggregates, they can be key columns too.
+        """
+        return sorted(set(args[0] for op_name, args, _ in self.calls if op_name == FeatureType.AGGREGATE))
+
+
+    def partial_fit(self, chunk):
+        for call in self.calls:
+            op_name, args, stat_list = call
+            state = self.state.get(call)
+            if op_name == FeatureType.COUNT:
+                state = add_counts(state, chunk[args[0]].value_counts())
+            elif op_name == FeatureType.CROSSCOUNT:
+                state = add_counts(state, chunk.groupby(list(args)).size())
+            elif op_name == FeatureType.AGGREGATE:
+                num_col, col = args
+                # a key column too is read as str, the values are parsed back
+                group = pd.to_numeric(chunk[num_col], errors='coerce').groupby(chunk[col])
+                moments = group.agg(['count', 'sum', 'min', 'max', 'var'])
+                moments['m2'] = (moments.pop('var') * (moments['count'] - 1)).fillna(0)
+                pairs = group.value_counts() if 'median' in stat_list else None
+                state = (
+                    merge_moments(state and state[0], moments),
+                    add_counts(state and state[1], pairs))
+            elif op_name == FeatureType.NUNIQUE and self.nunique_precision is not None:
+                state = self.partial_registers(state, chunk, *args)
+            elif op_name == FeatureType.NUNIQUE:
+                id_col, col = args
+                pairs = chunk.groupby([col, id_col], dropna=False).size()
+                state = add_counts(state, pairs[pairs.index.get_level_values(0).notnull()])
+            elif op_name == FeatureType.HISTSTAT:
+                id_col, col = args
+                state = (
+                    add_counts(state and state[0], chunk[id_col].value_counts()),
+                    add_counts(state and state[1], chunk.groupby([col, id_col]).size()))
+            self.state[call] = state
+        self.tables = None
+
+
+    def partial_registers(self, state, chunk, id_col, col):
+        """
+        add one chunk to the HyperLogLog state (keys, cells, ranks) of the
+        id_col values of every col key. Only the cells hit by a row are
+        kept, a cell is key position * 2 ** precision + register.
+        """
+        if state is None:
+            state = (pd.Index([], dtype=object), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8))
+        keys, cells, ranks = state
+        m = 1 << self.nunique_precision
+        key = chunk[col]
+        # new keys go last, the cells of the known ones keep their position
+        keys = keys.append(pd.Index(key.dropna().unique()).difference(keys))
+        position = keys.get_indexer(key.values)
+        valid = (position >= 0) & chunk[id_col].notnull().values
+        # a stable hash of the values, the same id hashes alike in every chunk
+        hashed = pd.util.hash_pandas_object(chunk[id_col][valid], index=False).values
+        register, rank = hll_rank(hashed, self.nunique_precision)
+        cells, ranks = max_registers(
+            np.concatenate([cells, position[valid] * m + register]), np.concatenate([ranks, rank]))
+        return keys, cells, ranks
+
+
+    def finalize(self):
+        """
+        turn the accumulated state into per key lookup tables.
+        """
+        self.tables = {}
+        for call in self.calls:
+            op_name, args, stat_list = call
+            state = self.state.get(call)
+            if op_name in [FeatureType.COUNT, FeatureType.CROSSCOUNT]:
+                table = state
+            elif op_name == FeatureType.AGGREGATE:
+                moments, pairs = state
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    table = pd.DataFrame({
+                        'min': moments['min'],
+                        'max': moments['max'],
+                        'mean': moments['sum'] / moments['count'],
+                        'var': (moments['m2'] / (moments['count'] - 1)).where(moments['count'] > 1),
+                        })
+                if pairs is not None:
+                    median = weighted_group_stats(
+                        pairs.index.get_level_values(0), pairs.index.get_level_values(1), pairs.values, ['median'])
+                    table['median'] = median['median'].reindex(table.index)
+            elif op_name == FeatureType.NUNIQUE and self.nunique_precision is not None:
+                keys, cells, ranks = state
+                m = 1 << self.nunique_precision
+                group = cells // m
+                # keys without any id count 0, the empty registers of a key count 2 ** 0 each
+                empty = m - np.bincount(group, minlength=len(keys))
+                total = np.bincount(group, weights=np.exp2(-ranks.astype(float)), minlength=len(keys)) + empty
+                table = pd.Series(hll_estimate(total, empty, m), index=keys)
+            elif op_name == FeatureType.NUNIQUE:
+                frame = state.index.to_frame(index=False)
+                table = frame.iloc[:, 1].notnull().groupby(frame.iloc[:, 0].values).sum()
+            elif op_name == FeatureType.HISTSTAT:
+                id_counts, pairs = state
+                id_value = id_counts.reindex(pairs.index.get_level_values(1)).values
+                table = weighted_group_stats(
+                    pairs.index.get_level_values(0), id_value, pairs.values, stat_list)
+            self.tables[call] = table
+
+
+    def transform(self, chunk):
+        """
+        append the feature columns to one chunk.
+        """
+        if self.tables is None:
+            self.finalize()
+        for call in self.calls:
+            op_name, args, stat_list = call
+            table = self.tables[call]
+            if table is None:
+                continue
+            if op_name == FeatureType.COUNT:
+                chunk['count_{}'.format(args[0])] = lookup(table, chunk, args)
+            elif op_name == FeatureType.CROSSCOUNT:
+                chunk['count_' + '_'.join(args)] = lookup(table, chunk, args)
+            elif op_name == FeatureType.AGGREGATE:
+                for i in stat_list:
+                    chunk['AGG_{}_{}_{}'.format(i, args[0], args[1])] = lookup(table[i], chunk, args[1:])
+            elif op_name == FeatureType.NUNIQUE:
+                chunk['NUNIQUE_{}_{}'.format(*args)] = lookup(table, chunk, args[1:])
+            elif op_name == FeatureType.HISTSTAT:
+                for i in stat_list:
+                    chunk['HISTSTAT_{}_{}_{}'.format(i, args[0], args[1])] = lookup(table[i], chunk, args[1:])
+        return chunk
+
+
+def name2feature_stream(file_name, feature_space, chunksize=1000000, nunique_precision=None, **kwargs):
+    """
+    out of core name2feature, read file_name twice chunk by chunk and
+    yield every chunk with the generated features.
+
+    The state of aggregate median, histstat and exact nunique grows with
+    the distinct (key, value) pairs, not only with the keys: on high
+    cardinality values it can approach the row count. Set
+    nunique_precision to count nunique with HyperLogLog registers instead,
+    median and histstat have no bounded mode.
+    kwargs : passed to pd.read_csv
+    """
+    builder = StreamFeatureBuilder(feature_space, nunique_precision)
+    dtype = dict((i, str) for i in builder.key_columns())
+    dtype.update(kwargs.pop('dtype', {}))
+    numeric = [i for i in builder.value_columns() if dtype.get(i) is str]
+    for chunk in pd.read_csv(file_name, chunksize=chunksize, dtype=dtype, **kwargs):
+        builder.partial_fit(chunk)
+    for chunk in pd.read_csv(file_name, chunksize=chunksize, dtype=dtype, **kwargs):
+        chunk = builder.transform(chunk)
+        # the values of the columns used as key and as aggregate value
+        for i in numeric:
+            chunk[i] = pd.to_numeric(chunk[i], errors='coerce')
+        yield chunk
+
+
+def stream_into(buffer, file_name, feature_space, chunksize=1000000, nunique_precision=None, **kwargs):
+    """
+    generate the features of feature_space supported in streaming mode
+    chunk by chunk into the rows of a fe_util.ColumnBuffer over the same
+    file, only the key and value columns are parsed.
+
+    return the features left for name2feature, target and embedding.
+    """
+    supported, rest = [], []
+    for name in feature_space:
+        if parse_feature(name)[0] in [FeatureType.TARGET, FeatureType.EMBEDDING]:
+            rest.append(name)
+        else:
+            supported.append(name)
+    if len(supported) == 0:
+        return rest
+
+    builder = StreamFeatureBuilder(supported)
+    usecols = sorted(set(builder.key_columns()) | set(builder.value_columns()))
+    columns = [j for i in supported for j in feature_columns(i)]
+    start = 0
+    for chunk in name2feature_stream(
+            file_name, supported, chunksize, nunique_precision, usecols=usecols, **kwargs):
+        for col in columns:
+            buffer.write_rows(col, start, chunk[col].values)
+        start += len(chunk)
+    if start != len(buffer):
+        raise RuntimeError('The streamed file has {} rows, the buffer {}'.format(start, len(buffer)))
+    return rest
@@ -0,0 +1,449 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+
+from const import FeatureType, AGGREGATE_TYPE
+from fe_util import GroupKey, compile_plan, group_agg, distinct_counts, tokenize, bag_of_words, bag_mean, fit_embedding
+
+# codes of a null value and of a value unseen in training
+MISSING = -1
+UNSEEN = -2
+# batches up to this size are encoded by dict lookups instead of searchsorted
+SMALL_BATCH = 16
+
+
+def is_null(value):
+    return value is None or value != value
+
+
+def to_float(values):
+    """
+    float array of values, nulls become nan.
+    """
+    if len(values) <= SMALL_BATCH:
+        return np.array([np.nan if is_null(i) else float(i) for i in values])
+    values = np.asarray(values, dtype=object)
+    missing = pd.isnull(values)
+    result = np.full(len(values), np.nan)
+    result[~missing] = values[~missing].astype(float)
+    return result
+
+
+class Vocabulary:
+    """
+    sorted distinct values of a raw column and the code of each of them.
+    Numeric columns are compared as floats, the others as strings.
+    """
+    def __init__(self, values, codes=None):
+        self.values = values
+        self.codes = np.arange(len(values), dtype=np.int64) if codes is None else codes
+        self._index = None
+
+
+    @classmethod
+    def fit(cls, column):
+        column = column[column.notnull()]
+        if pd.api.types.is_numeric_dtype(column):
+            return cls(np.unique(column.values.astype(float)))
+        return cls(np.unique(np.asarray(column.astype(str).values, dtype='U')))
+
+
+    def encode(self, values):
+        """
+        codes of values, MISSING for nulls and UNSEEN for unknown values.
+        """
+        if len(values) <= SMALL_BATCH:
+            return self.encode_small(values)
+        values = np.asarray(values, dtype=object)
+        missing = pd.isnull(values)
+        if self.values.dtype.kind == 'f':
+            x = np.nan_to_num(to_float(values))
+        else:
+            x = values.astype(str)
+        codes = np.full(len(values), UNSEEN, dtype=np.int64)
+        if len(self.values) > 0:
+            pos = np.minimum(np.searchsorted(self.values, x), len(self.values) - 1)
+            found = self.values[pos] == x
+            codes[found] = self.codes[pos[found]]
+        codes[missing] = MISSING
+        return codes
+
+
+    def encode_small(self, values):
+        if self._index is None:
+            self._index = dict(zip(self.values.tolist(), self.codes.tolist()))
+        convert = float if self.values.dtype.kind == 'f' else str
+        return np.array(
+            [MISSING if is_null(i) else self._index.get(convert(i), UNSEEN) for i in values], dtype=np.int64)
+
+
+class TableTransformer:
+    """
+    fitted group by feature: a sorted int64 table of the training keys
+    (mixed radix of the column codes) and the output values of each key.
+
+    missing : output values of a row with a null key column.
+    default : output values of a key unseen in training.
+    """
+    def __init__(self, columns, outputs, radix, keys, values, missing, default):
+        self.columns = list(columns)
+        self.outputs = list(outputs)
+        self.radix = np.asarray(radix, dtype=np.int64)
+        self.keys = keys
+        self.values = values
+        self.missing = np.asarray(missing, dtype=float)
+        self.default = np.asarray(default, dtype=float)
+
+
+    def transform(self, batch, codes):
+        n = len(codes[self.columns[0]])
+        key = np.zeros(n, dtype=np.int64)
+        missing = np.zeros(n, dtype=bool)
+        found = np.ones(n, dtype=bool)
+        for col, radix in zip(self.columns, self.radix):
+            missing |= codes[col] == MISSING
+            found &= codes[col] >= 0
+            key = key * radix + np.maximum(codes[col], 0)
+        result = np.empty((n, len(self.outputs)))
+        result[:] = self.default
+        if len(self.keys) > 0:
+            pos = np.minimum(np.searchsorted(self.keys, key), len(self.keys) - 1)
+            found &= self.keys[pos] == key
+            result[found] = self.values[pos[found]]
+        result[missing] = self.missing
+        return result
+
+
+    def state(self):
+        meta = {'kind': 'table', 'columns': self.columns, 'outputs': self.outputs}
+        arrays = {
+            'radix': self.radix, 'keys': self.keys, 'values': self.values,
+            'missing': self.missing, 'default': self.default}
+        return meta, arrays
+
+
+class EmbeddingTransformer:
+    """
+    fitted embedding of a multi-categories column: the sorted known tokens
+    and their projected vectors, see fe_util.fit_embedding.
+    """
+    def __init__(self, col, outputs, tokens, projection):
+        self.col = col
+        self.outputs = list(outputs)
+        self.tokens = tokens
+        self.projection = projection
+
+
+    def transform(self, batch, codes):
+        _, rows, token_codes, vocab = tokenize(pd.Series(batch[self.col]))
+        index = np.full(len(vocab), -1, dtype=np.int64)
+        if len(self.tokens) > 0:
+            pos = np.minimum(np.searchsorted(self.tokens, vocab), len(self.tokens) - 1)
+            index = np.where(self.tokens[pos] == vocab, pos, -1)
+        n = len(batch[self.col])
+        return bag_mean(bag_of_words(rows, index[token_codes], n, len(self.tokens)), self.projection)
+
+
+    def state(self):
+        meta = {'kind': 'embedding', 'col': self.col, 'outputs': self.outputs}
+        return meta, {'tokens': self.tokens, 'projection': self.projection}
+
+
+class RawFeature:
+    """
+    raw model input column, label encoded like model.encode_features: a
+    code for every string or category value, numbers as they are.
+
+    missing_code : code of a null value, nan when training had none.
+    """
+    def __init__(self, col, vocabulary=None, missing_code=np.nan):
+        self.col = col
+        self.vocabulary = vocabulary
+        self.missing_code = missing_code
+
+
+    @classmethod
+    def fit(cls, column):
+        if str(column.dtype) == 'category' and column.nunique(dropna=False) >= 12:
+            # the codes of the categories
+            categories = np.asarray(column.cat.categories.astype(str), dtype='U')
+            order = np.argsort(categories)
+            return cls(column.name, Vocabulary(categories[order], order), -1)
+        if str(column.dtype) == 'category' or not pd.api.types.is_numeric_dtype(column):
+            # the codes of the sorted values, nulls are the string 'na'
+            vocabulary = Vocabulary.fit(column.astype(object).fillna('na').astype(str))
+            codes = vocabulary.encode(['na'])
+            return cls(column.name, vocabulary, float(codes[0]) if codes[0] >= 0 else np.nan)
+        return cls(column.name)
+
+
+    def transform(self, batch):
+        values = batch[self.col]
+        if self.vocabulary is None:
+            return to_float(values)
+        codes = self.vocabulary.encode(values).astype(float)
+        codes[codes == MISSING] = self.missing_code
+        codes[codes == UNSEEN] = np.nan
+        return codes
+
+
+    def state(self):
+        meta = {'col': self.col, 'missing_code': self.missing_code, 'encoded': self.vocabulary is not None}
+        arrays = {}
+        if self.vocabulary is not None:
+            arrays = {'values': self.vocabulary.values, 'codes': self.vocabulary.codes}
+        return meta, arrays
+
+
+# op_name -> fit function of the op, see register_fit
+FIT_REGISTRY = {}
+
+
+def register_fit(op_name):
+    """
+    register the fit function of a feature operator.
+
+    fit(df, key, *args, stat_list=..., target_name=...) gets the GroupKey
+    of the training keys and returns (outputs, values of shape
+    (n_groups, len(outputs)), missing values, default values).
+    """
+    def wrapper(func):
+        FIT_REGISTRY[op_name] = func
+        return func
+    return wrapper
+
+
+@register_fit(FeatureType.COUNT)
+def fit_count(df, key, col, **kwargs):
+    return ['count_{}'.format(col)], key.counts()[:, None], [np.nan], [0]
+
+
+@register_fit(FeatureType.CROSSCOUNT)
+def fit_crosscount(df, key, col_list, **kwargs):
+    return ['count_' + '_'.join(col_list)], key.counts()[:, None], [np.nan], [0]
+
+
+@register_fit(FeatureType.AGGREGATE)
+def fit_aggregate(df, key, num_col, col, stat_list=AGGREGATE_TYPE, **kwargs):
+    agg_result = group_agg(df[num_col].values, key, stat_list)
+    outputs = ['AGG_{}_{}_{}'.format(i, num_col, col) for i in stat_list]
+    values = np.stack([agg_result[i] for i in stat_list], axis=1)
+    return outputs, values, [np.nan] * len(outputs), [np.nan] * len(outputs)
+
+
+@register_fit(FeatureType.NUNIQUE)
+def fit_nunique(df, key, id_col, col, **kwargs):
+    values = distinct_counts(key, GroupKey.from_column(df[id_col]))
+    return ['NUNIQUE_{}_{}'.format(id_col, col)], values[:, None], [np.nan], [np.nan]
+
+
+@register_fit(FeatureType.HISTSTAT)
+def fit_histstat(df, key, id_col, col, stat_list=AGGREGATE_TYPE, **kwargs):
+    id_key = GroupKey.from_column(df[id_col])
+    agg_result = group_agg(id_key.broadcast(id_key.counts()), key, stat_list)
+    outputs = ['HISTSTAT_{}_{}_{}'.format(i, id_col, col) for i in stat_list]
+    values = np.stack([agg_result[i] for i in stat_list], axis=1)
+    return outputs, values, [np.nan] * len(outputs), [np.nan] * len(outputs)
+
+
+@register_fit(FeatureType.TARGET)
+def fit_target(df, key, col, target_name='label', p=0.5, a=1, **kwargs):
+    """
+    the smoothed target mean of every key on all the training rows, like
+    fe_util.target encodes the rows without target.
+    """
+    y = df[target_name].values.astype(float)
+    train = ~np.isnan(y)
+    mean_of_target = y[train].mean()
+    # the missing values of col are a category of their own
+    codes = np.where(key.valid, key.codes, key.n_groups)[train]
+    total_sum = np.bincount(codes, weights=y[train], minlength=key.n_groups + 1)
+    total_cnt = np.bincount(codes, minlength=key.n_groups + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = np.where(total_cnt > 0, (total_sum + p * a) / (total_cnt + a), mean_of_target)
+    return ['target_{}'.format(col)], values[:-1, None], [values[-1]], [mean_of_target]
+
+
+def fit_key(df, vocabularies, columns):
+    """
+    table keys of the training rows on columns.
+    return (GroupKey of the rows, radix, sorted int64 keys)
+    """
+    radix = [max(len(vocabularies[i].values), 1) for i in columns]
+    if np.prod([float(i) for i in radix]) >= 2 ** 62:
+        raise RuntimeError('Too many keys to fit on: ' + str(columns))
+    key = np.zeros(len(df), dtype=np.int64)
+    valid = np.ones(len(df), dtype=bool)
+    for col, r in zip(columns, radix):
+        codes = vocabularies[col].encode(df[col].values)
+        valid &= codes >= 0
+        key = key * r + np.maximum(codes, 0)
+    keys = np.unique(key[valid])
+    codes = np.where(valid, np.searchsorted(keys, key), -1)
+    return GroupKey(codes, len(keys)), radix, keys
+
+
+class FeaturePipeline:
+    """
+    fitted feature set plus the LightGBM booster trained on it, scores
+    single rows or micro-batches with table lookups only.
+
+    rows : dict of column -> value (one row), dict of column -> list of
+    values, or a DataFrame.
+    """
+    def __init__(self, feature_name, vocabularies, raw_features, transformers, booster):
+        self.feature_name = list(feature_name)
+        self.vocabularies = vocabularies
+        self.raw_features = raw_features
+        self.transformers = transformers
+        self.booster = booster
+        position = dict((j, i) for i, j in enumerate(self.feature_name))
+        self.raw_position = [position[i.col] for i in raw_features]
+        # outputs of a transformer that are not model features are dropped
+        self.position = [
+            ([k for k, j in enumerate(i.outputs) if j in position], [position[j] for j in i.outputs if j in position])
+            for i in transformers]
+
+
+    def batch(self, rows):
+        if isinstance(rows, pd.DataFrame):
+            return dict((i, rows[i].values) for i in rows.columns)
+        batch = {}
+        for col, value in rows.items():
+            if np.ndim(value) == 0:
+                value = [value]
+            batch[col] = np.asarray(value, dtype=object)
+        return batch
+
+
+    def transform(self, rows):
+        """
+        model input matrix of rows, in the feature order of the booster.
+        """
+        batch = self.batch(rows)
+        codes = dict((col, i.encode(batch[col])) for col, i in self.vocabularies.items())
+        n = len(next(iter(batch.values())))
+        X = np.empty((n, len(self.feature_name)))
+        for raw, position in zip(self.raw_features, self.raw_position):
+            X[:, position] = raw.transform(batch)
+        for transformer, (index, position) in zip(self.transformers, self.position):
+            X[:, position] = transformer.transform(batch, codes)[:, index]
+        return X
+
+
+    def predict(self, rows):
+        return self.booster.predict(self.transform(rows))
+
+
+    def save(self, path):
+        """
+        write the pipeline under the directory path: pipeline.json, the
+        arrays in arrays.npz and the booster in booster.txt.
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = {}
+        meta = {'feature_name': self.feature_name, 'vocabularies': [], 'raw_features': [], 'transformers': []}
+        for i, (col, vocabulary) in enumerate(self.vocabularies.items()):
+            meta['vocabularies'].append(col)
+            arrays['vocabulary_{}_values'.format(i)] = vocabulary.values
+            arrays['vocabulary_{}_codes'.format(i)] = vocabulary.codes
+        for group in ['raw_features', 'transformers']:
+            for i, item in enumerate(getattr(self, group)):
+                item_meta, item_arrays = item.state()
+                meta[group].append(item_meta)
+                for name, value in item_arrays.items():
+                    arrays['{}_{}_{}'.format(group, i, name)] = value
+        with open(os.path.join(path, 'pipeline.json'), 'w') as f:
+            json.dump(meta, f)
+        np.savez(os.path.join(path, 'arrays.npz'), **arrays)
+        self.booster.save_model(os.path.join(path, 'booster.txt'))
+
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'pipeline.json')) as f:
+            meta = json.load(f)
+        with np.load(os.path.join(path, 'arrays.npz'), allow_pickle=False) as f:
+            arrays = dict(f.items())
+        vocabularies = dict(
+            (col, Vocabulary(arrays['vocabulary_{}_values'.format(i)], arrays['vocabulary_{}_codes'.format(i)]))
+            for i, col in enumerate(meta['vocabularies']))
+        raw_features = []
+        for i, item in enumerate(meta['raw_features']):
+            vocabulary = None
+            if item['encoded']:
+                vocabulary = Vocabulary(
+                    arrays['raw_features_{}_values'.format(i)], arrays['raw_features_{}_codes'.format(i)])
+            raw_features.append(RawFeature(item['col'], vocabulary, item['missing_code']))
+        transformers = []
+        for i, item in enumerate(meta['transformers']):
+            a = dict((j, arrays['transformers_{}_{}'.format(i, j)])
+                     for j in ['radix', 'keys', 'values', 'missing', 'default', 'tokens', 'projection']
+                     if 'transformers_{}_{}'.format(i, j) in arrays)
+            if item['kind'] == 'table':
+                transformers.append(TableTransformer(
+                    item['columns'], item['outputs'], a['radix'], a['keys'], a['values'], a['missing'], a['default']))
+            else:
+                transformers.append(EmbeddingTransformer(item['col'], item['outputs'], a['tokens'], a['projection']))
+        booster = lgb.Booster(model_file=os.path.join(path, 'booster.txt'))
+        return cls(meta['feature_name'], vocabularies, raw_features, transformers, booster)
+
+
+def fit_pipeline(df, feature_space, booster, target_name='label', cache=None):
+    """
+    fit the transformers of the feature names in feature_space on the
+    training rows df, and wrap them with booster in a FeaturePipeline.
+    The raw model inputs are the booster features no transformer outputs.
+
+    cache : optional FeatureCache holding the fitted embedding models.
+    """
+    plan = compile_plan(feature_space)
+    vocabularies = {}
+    transformers = []
+    for key_cols, calls in plan:
+        if key_cols is None:
+            for op_name, args, _ in calls:
+                col = args[0]
+                model = cache.get('model_embedding_' + col) if cache is not None else None
+                if model is None:
+                    tokens, projection = fit_embedding(*tokenize(df[col]))
+                else:
+                    tokens, projection = np.asarray(model['tokens']), np.asarray(model['projection'])
+                order = np.argsort(tokens)
+                outputs = ['embedding_{}_{}'.format(col, i) for i in range(projection.shape[1])]
+                transformers.append(EmbeddingTransformer(col, outputs, tokens[order], projection[order]))
+            continue
+        for col in key_cols:
+            if col not in vocabularies:
+                vocabularies[col] = Vocabulary.fit(df[col])
+        key, radix, keys = fit_key(df, vocabularies, key_cols)
+        for op_name, args, stat_list in calls:
+            kwargs = {'target_name': target_name}
+            if stat_list:
+                kwargs['stat_list'] = stat_list
+            outputs, values, missing, default = FIT_REGISTRY[op_name](df, key, *args, **kwargs)
+            transformers.append(TableTransformer(
+                key_cols, outputs, radix, keys, np.asarray(values, dtype=float), missing, default))
+
+    outputs = set(j for i in transformers for j in i.outputs)
+    raw_features = [RawFeature.fit(df[i]) for i in booster.feature_name() if i not in outputs]
+    return FeaturePipeline(booster.feature_name(), vocabularies, raw_features, transformers, booster)
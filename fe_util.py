@@ -17,157 +17,538 @@
 
 import pandas as pd
 import numpy as np 
+from collections import OrderedDict
+from scipy import sparse
 from sklearn.model_selection import KFold
 from sklearn.decomposition import TruncatedSVD
 
 from const import FeatureType, AGGREGATE_TYPE
+from profiler import Profiler
 
+# smaller tables are generated serially, shipping the columns to the
+# process pool costs more than the operators on them
+PARALLEL_MIN_ROWS = 100000
 
-def left_merge(data1, data2, on):
+
+class ColumnBuffer:
     """
-    merge util for dataframe
+    preallocated output columns of the operators on a dataframe.
+
+    The planned feature columns share one Fortran ordered 2-D array, so
+    every column is contiguous and the array goes to lgb.Dataset without
+    a copy, instead of one pandas block per column. The operators see it
+    as the dataframe: the raw columns are read from df, an output column
+    is written into its slot.
+    df : the raw dataframe, it is not modified.
+    columns : the output columns, e.g. feature_columns of the sampled features.
     """
-    if type(on) != list:
-        on = [on]
-    if (set(on) & set(data2.columns)) != set(on):
-        data2_temp = data2.reset_index()
-    else:
-        data2_temp = data2.copy()
-    columns = [f for f in data2.columns if f not in on]
-    result = data1.merge(data2_temp, on = on, how='left')
-    result = result[columns]
-    return result
+    def __init__(self, df, columns, dtype=np.float64):
+        self.df = df
+        self.slot = OrderedDict((col, i) for i, col in enumerate(columns))
+        self.values = np.full((len(df), len(self.slot)), np.nan, dtype=dtype, order='F')
+        self.written = OrderedDict()
+
+
+    def __len__(self):
+        return len(self.df)
+
+
+    @property
+    def columns(self):
+        return list(self.df.columns) + list(self.written)
+
+
+    def __getitem__(self, col):
+        if col in self.slot:
+            return pd.Series(self.values[:, self.slot[col]], index=self.df.index, name=col, copy=False)
+        return self.df[col]
+
+
+    def __setitem__(self, col, values):
+        self.write_rows(col, 0, values)
+
+
+    def write_rows(self, col, start, values):
+        """
+        write values into the rows start.. of the slot of col, e.g. a chunk.
+        """
+        if col not in self.slot:
+            raise RuntimeError('No slot planned for the column: ' + str(col))
+        self.values[start:start + len(values), self.slot[col]] = values
+        self.written[col] = True
 
 
-def concat(L):
+    def select(self, columns):
+        """
+        return (columns, 2-D array) of some output columns, a view when
+        they are consecutive slots, e.g. all the outputs of a trial.
+        """
+        index = [self.slot[col] for col in columns]
+        if len(index) > 0 and index == list(range(index[0], index[0] + len(index))):
+            return list(columns), self.values[:, index[0]:index[0] + len(index)]
+        return list(columns), self.values[:, index]
+
+
+class GroupKey:
     """
-    tools for concat some dataframes into a new dataframe.
+    factorized group by key, codes is -1 for rows with a missing key.
     """
-    result = None
-    for l in L:
-        if l is None:
-            continue
-        if result is None:
-            result = l
-        else:
-            result[l.columns.tolist()] = l
-    return result
+    def __init__(self, codes, n_groups):
+        self.codes = codes
+        self.n_groups = n_groups
+        self.valid = codes >= 0
 
 
-def name2feature(df, feature_space, target_name='label'):
-    assert isinstance(feature_space, list)
+    @classmethod
+    def from_column(cls, column):
+        codes, uniques = pd.factorize(column)
+        return cls(codes.astype(np.int32), len(uniques))
+
+
+    @classmethod
+    def combine(cls, keys):
+        """
+        cross key of several column keys.
+
+        The int codes are mixed into one int64 arithmetically instead of
+        a pandas multi-key groupby, and compacted by a hash factorize
+        whenever the code range outgrows the number of rows, so memory
+        stays proportional to rows.
+        """
+        codes, n_groups = keys[0].codes.astype(np.int64), keys[0].n_groups
+        for key in keys[1:]:
+            codes = np.where((codes >= 0) & key.valid, codes * key.n_groups + key.codes, -1)
+            n_groups = n_groups * key.n_groups
+            if n_groups > len(codes):
+                codes, n_groups = compact_codes(codes)
+        return cls(codes, n_groups)
+
+
+    def counts(self):
+        """
+        number of rows in every group.
+        """
+        return np.bincount(self.codes[self.valid], minlength=self.n_groups)
+
+
+    def broadcast(self, values):
+        """
+        map per group values back to rows, missing keys get nan.
+        """
+        values = np.append(np.asarray(values, dtype=float), np.nan)
+        return values[self.codes]
+
+
+def compact_codes(codes):
+    """
+    renumber the used codes into 0..n-1, keep -1 for missing.
+    """
+    valid = codes >= 0
+    result = np.full(len(codes), -1, dtype=np.int64)
+    result[valid], uniques = pd.factorize(codes[valid], sort=False)
+    return result, len(uniques)
+
+
+class KeyCache:
+    """
+    group by keys of one dataframe, every key is factorized only once
+    and shared by all the operators grouping by it. Cross keys are built
+    from the single column keys, so a column is hashed once for all of
+    its crosscount pairs.
+    """
+    def __init__(self, df):
+        self.df = df
+        self.keys = {}
+
+
+    def get(self, cols):
+        cols = tuple(cols)
+        if cols not in self.keys:
+            if len(cols) == 1:
+                self.keys[cols] = GroupKey.from_column(self.df[cols[0]])
+            else:
+                self.keys[cols] = GroupKey.combine([self.get([i]) for i in cols])
+        return self.keys[cols]
+
+
+    def release(self, cols):
+        self.keys.pop(tuple(cols), None)
+
+
+# op_name -> (operator, group by key of the feature args, output columns of the feature args)
+OP_REGISTRY = {}
+
+
+def register_op(op_name, key=None, columns=None):
+    """
+    register a feature operator under its FeatureType name.
+    """
+    def wrapper(func):
+        OP_REGISTRY[op_name] = (func, key, columns)
+        return func
+    return wrapper
+
+
+def parse_feature(name):
+    """
+    split a feature name into op name and args, e.g.
+    aggregate_mean_I9_C2 -> ('aggregate', ['mean', 'I9', 'C2'])
+    """
+    temp = name.split('_')
+    if len(temp) < 2 or len(temp) > 4 or temp[0] not in OP_REGISTRY:
+        raise RuntimeError('Do not support this OP: ' + str(name))
+    return temp[0], temp[1:]
+
+
+def feature_columns(name):
+    """
+    the dataframe columns generated by one feature name.
+    """
+    op_name, args = parse_feature(name)
+    return OP_REGISTRY[op_name][2](args)
+
 
-    for key in feature_space:
-        temp = key.split('_')
-        assert len(temp) > 1
-
-        op_name = temp[0]
-        if len(temp) == 2:
-            i = temp[1]
-            command = op_name + '(df, i)'
-        elif len(temp) == 3:
-            i, j = temp[1], temp[2]
-            command = op_name + '(df, [i, j])'
-        elif len(temp) == 4:
-            stat, i, j = temp[1], temp[2], temp[3]
-            command = op_name + '(df, i, j, [stat])'
+def compile_plan(feature_space):
+    """
+    compile feature names into an execution plan.
+
+    Features sharing the same group by key go into one group, so the key
+    is factorized once. Aggregate stats on the same (num_col, col) are
+    merged into a single call.
+    return [(key_cols, [(op_name, args, stat_list), ...]), ...]
+    """
+    groups = OrderedDict()
+    for name in feature_space:
+        op_name, args = parse_feature(name)
+        key_cols = OP_REGISTRY[op_name][1]
+        key_cols = tuple(key_cols(args)) if key_cols is not None else None
+        stat = None
+        if op_name == FeatureType.AGGREGATE:
+            stat, args = args[0], args[1:]
+        elif op_name == FeatureType.CROSSCOUNT:
+            args = [tuple(args)]
+        calls = groups.setdefault(key_cols, OrderedDict())
+        stat_list = calls.setdefault((op_name, tuple(args)), [])
+        if stat is not None and stat not in stat_list:
+            stat_list.append(stat)
+
+    plan = []
+    for key_cols, calls in groups.items():
+        plan.append((key_cols, [(op_name, args, stat_list) for (op_name, args), stat_list in calls.items()]))
+    return plan
+
+
+def call_columns(op_name, args):
+    """
+    raw columns read by one plan call.
+    """
+    return list(args[0]) if op_name == FeatureType.CROSSCOUNT else list(args)
+
+
+def run_plan(df, plan, target_name='label', keys=None, profiler=None, cache=None):
+    """
+    execute a compiled plan group by group.
+
+    keys : optional KeyCache holding already factorized keys of df.
+    profiler : optional Profiler, gets a 'feature' record per call.
+    cache : optional FeatureCache, keeps the fitted embedding models.
+    """
+    keys = keys or KeyCache(df)
+    profiler = profiler or Profiler()
+    for key_cols, calls in plan:
+        for op_name, args, stat_list in calls:
+            kwargs = {}
+            if key_cols is not None:
+                kwargs['keys'] = keys
+            if stat_list:
+                kwargs['stat_list'] = stat_list
+            if op_name == FeatureType.TARGET:
+                kwargs['target_name'] = target_name
+            if op_name == FeatureType.EMBEDDING and cache is not None:
+                kwargs['cache'] = cache
+            n_columns = len(df.columns)
+            # merged aggregate stats are one feature each
+            with profiler.stage('feature', op = op_name, columns = call_columns(op_name, args),
+                                features = max(len(stat_list), 1)):
+                df = OP_REGISTRY[op_name][0](df, *args, **kwargs)
+            profiler.records[-1]['outputs'] = len(df.columns) - n_columns
+        # single column keys are kept for the later cross keys
+        if key_cols is not None and len(key_cols) > 1:
+            keys.release(key_cols)
+    return df
+
+
+def name2feature(df, feature_space, target_name='label', cache=None, n_workers=1, profiler=None):
+    """
+    generate every feature in feature_space.
+
+    cache : optional FeatureCache, features already stored are loaded
+    instead of recomputed, new ones are written back.
+    n_workers : processes running the plan groups, 1 runs serially, as
+    does a table of less than PARALLEL_MIN_ROWS rows.
+    profiler : optional Profiler recording the cache and operator stages.
+    """
+    assert isinstance(feature_space, list)
+    profiler = profiler or Profiler()
+
+    def cache_name(name):
+        # a target encoding depends on the label column too
+        if parse_feature(name)[0] == FeatureType.TARGET:
+            return '{}.{}'.format(name, target_name)
+        return name
+
+    if cache is not None:
+        todo = []
+        with profiler.stage('cache_read'):
+            for key in feature_space:
+                cached = cache.get(cache_name(key))
+                if cached is None:
+                    todo.append(key)
+                    continue
+                for col, value in cached.items():
+                    df[col] = value
+        profiler.records[-1]['hits'] = len(feature_space) - len(todo)
+        feature_space = todo
+
+    plan = compile_plan(feature_space)
+    if len(df) < PARALLEL_MIN_ROWS:
+        n_workers = 1
+    with profiler.stage('generate', n_workers = n_workers):
+        if n_workers > 1:
+            from fe_parallel import run_plan_parallel
+            df = run_plan_parallel(df, plan, target_name, n_workers, profiler, cache)
         else:
-            raise RuntimeError('Do not support this OP: ' + str(key))
+            df = run_plan(df, plan, target_name, profiler = profiler, cache = cache)
 
-        df = eval(command)
-    
+    if cache is not None:
+        with profiler.stage('cache_write'):
+            for key in feature_space:
+                cache.put(cache_name(key), dict((i, df[i]) for i in feature_columns(key)))
     return df
 
 
-def count(df, col):
+@register_op(
+    FeatureType.COUNT,
+    key = lambda args: args,
+    columns = lambda args: ['count_{}'.format(args[0])])
+def count(df, col, keys=None):
     """
     tools for count encode
     """
-    df['count_{}'.format(col)] = df.groupby(col)[col].transform('count')
+    key = (keys or KeyCache(df)).get([col])
+    df['count_{}'.format(col)] = key.broadcast(key.counts())
     return df
 
 
-def crosscount(df, col_list):
+@register_op(
+    FeatureType.CROSSCOUNT,
+    key = lambda args: args,
+    columns = lambda args: ['count_' + '_'.join(args)])
+def crosscount(df, col_list, keys=None):
     """
     tools for multy thread bi_count
     """
-    assert isinstance(col_list, list)
+    assert isinstance(col_list, (list, tuple))
+    col_list = list(col_list)
     assert len(col_list) >= 2
     name = "count_"+ '_'.join(col_list)
-    df[name] = df.groupby(col_list)[col_list[0]].transform('count')
+    key = (keys or KeyCache(df)).get(col_list)
+    df[name] = key.broadcast(key.counts())
     return df
 
 
-def aggregate(df, num_col, col, stat_list = AGGREGATE_TYPE):
-    agg_dict = {}
+GROUP_AGG_STATS = ['count', 'sum', 'mean', 'var', 'std', 'min', 'max', 'median']
+
+
+def group_agg(values, key, stat_list):
+    """
+    per group statistics of values on a factorized key.
+
+    All stats come out of one pass: count/sum/mean/var/std by bincount,
+    min/max/median from one sort shared by all of them. Missing values
+    are skipped like pandas does.
+    return {stat: per group array}, nan for empty groups.
+    """
+    for stat in stat_list:
+        if stat not in GROUP_AGG_STATS:
+            raise RuntimeError('Do not support this aggregate stat: ' + str(stat))
+    values = np.asarray(values, dtype=float)
+    mask = key.valid & ~np.isnan(values)
+    codes, values = key.codes[mask], values[mask]
+    n = key.n_groups
+
+    result = {}
+    cnt = np.bincount(codes, minlength=n).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total = np.bincount(codes, weights=values, minlength=n)
+        mean = np.where(cnt > 0, total / cnt, np.nan)
+        if 'var' in stat_list or 'std' in stat_list:
+            square = np.bincount(codes, weights=(values - mean[codes]) ** 2, minlength=n)
+            var = np.where(cnt > 1, square / (cnt - 1), np.nan)
+            result['var'], result['std'] = var, np.sqrt(var)
+    result['count'], result['sum'], result['mean'] = cnt, total, mean
+
+    if len(set(stat_list) & {'min', 'max', 'median'}) > 0:
+        sorted_values = values[np.lexsort((values, codes))]
+        start = np.cumsum(cnt).astype(np.int64) - cnt.astype(np.int64)
+        size = cnt.astype(np.int64)
+        for stat, offset in [
+                ('min', np.zeros(n, dtype=np.int64)),
+                ('max', size - 1),
+                ('median', (size - 1) // 2)]:
+            result[stat] = segment_take(sorted_values, start + offset, size > 0)
+        # even sized groups average the two middle values
+        result['median'] = (result['median'] + segment_take(sorted_values, start + size // 2, size > 0)) / 2
+    return result
+
+
+def segment_take(sorted_values, index, nonempty):
+    """
+    take sorted_values[index] for non empty segments, nan for the others.
+    """
+    result = np.full(len(index), np.nan)
+    result[nonempty] = sorted_values[index[nonempty]]
+    return result
+
+
+@register_op(
+    FeatureType.AGGREGATE,
+    key = lambda args: args[2:],
+    columns = lambda args: ['AGG_{}_{}_{}'.format(*args)])
+def aggregate(df, num_col, col, stat_list = AGGREGATE_TYPE, keys=None):
+    key = (keys or KeyCache(df)).get([col])
+    agg_result = group_agg(df[num_col].values, key, stat_list)
     for i in stat_list:
-        agg_dict['AGG_{}_{}_{}'.format(i, num_col, col)] = i
-    agg_result = df.groupby([col])[num_col].agg(agg_dict)
-    r = left_merge(df, agg_result, on = [col])
-    df = concat([df, r])
+        df['AGG_{}_{}_{}'.format(i, num_col, col)] = key.broadcast(agg_result[i])
     return df
 
 
-def nunique(df, id_col, col):
+@register_op(
+    FeatureType.NUNIQUE,
+    key = lambda args: args[1:],
+    columns = lambda args: ['NUNIQUE_{}_{}'.format(*args)])
+def nunique(df, id_col, col, keys=None):
     """
     get id group_by(id) nunique
     """
-    agg_dict = {}
-    agg_dict['NUNIQUE_{}_{}'.format(id_col, col)] = 'nunique'
-    agg_result = df.groupby([col])[id_col].agg(agg_dict)
-    r = left_merge(df, agg_result, on = [col])
-    df = concat([df, r])
+    keys = keys or KeyCache(df)
+    key = keys.get([col])
+    id_key = keys.get([id_col])
+    agg_result = distinct_counts(key, id_key)
+    df['NUNIQUE_{}_{}'.format(id_col, col)] = key.broadcast(agg_result)
     return df
 
 
-def histstat(df, id_col, col, stat_list = AGGREGATE_TYPE):
+def distinct_counts(key, id_key):
+    """
+    number of distinct ids in every group, missing ids are skipped.
+
+    The (key, id) code pairs are packed into one int64 and sorted, every
+    run of equal pairs is one distinct id of its group.
+    """
+    valid = key.valid & id_key.valid
+    pairs = key.codes[valid].astype(np.int64) * id_key.n_groups + id_key.codes[valid]
+    pairs.sort()
+    first = np.ones(len(pairs), dtype=bool)
+    first[1:] = pairs[1:] != pairs[:-1]
+    return np.bincount(pairs[first] // id_key.n_groups, minlength=key.n_groups).astype(float)
+
+
+@register_op(
+    FeatureType.HISTSTAT,
+    key = lambda args: args[1:],
+    columns = lambda args: ['HISTSTAT_{}_{}_{}'.format(i, args[0], args[1]) for i in AGGREGATE_TYPE])
+def histstat(df, id_col, col, stat_list = AGGREGATE_TYPE, keys=None):
     """
     get id group_by(id) histgram statitics
     """
-    agg_dict = {}
+    keys = keys or KeyCache(df)
+    id_key = keys.get([id_col])
+    key = keys.get([col])
+    temp_count = id_key.broadcast(id_key.counts())
+    agg_result = group_agg(temp_count, key, stat_list)
     for i in stat_list:
-        agg_dict['HISTSTAT_{}_{}_{}'.format(i, id_col, col)] = i
-    df['temp_count'] = df.groupby(id_col)[id_col].transform('count')
-    agg_result = df.groupby([col])['temp_count'].agg(agg_dict)
-    r = left_merge(df, agg_result, on = [col])
-    df = concat([df, r])
-    del df['temp_count']
+        df['HISTSTAT_{}_{}_{}'.format(i, id_col, col)] = key.broadcast(agg_result[i])
     return df
 
 
-def base_embedding(x, model, size):
+def tokenize(column):
     """
-    embedding helper for bagofwords
+    split a multi-categories column on spaces.
+    return (row strings, row of every token, token codes, token vocabulary)
     """
-    vec = np.zeros(size)
-    x = [item for item in x if model.wv.__contains__(item)]
-    for item in x:
-        vec += model.wv[str(item)]
-    if len(x) == 0:
-        return vec
-    else:
-        return vec / len(x)
+    strings = [str(i) for i in column.astype(object).fillna('NA').values]
+    # one split of the joined rows instead of one per row
+    lengths = np.array([i.count(' ') for i in strings], dtype=np.int64) + 1
+    tokens = ' '.join(strings).split(' ')
+    codes, vocab = pd.factorize(np.array(tokens, dtype=object))
+    rows = np.repeat(np.arange(len(strings)), lengths)
+    return strings, rows, codes, np.asarray(vocab, dtype='U')
 
 
-def embedding(df, col):
+def bag_of_words(rows, codes, n_rows, n_tokens):
     """
-    This is the tool for multi-categories embedding encode.
-    embedding for one single multi-categories column.
+    sparse (n_rows, n_tokens) token counts of every row, codes of -1 are dropped.
+    """
+    known = codes >= 0
+    return sparse.csr_matrix(
+        (np.ones(known.sum()), (rows[known], codes[known])), shape=(n_rows, n_tokens))
+
+
+def bag_mean(bag, vectors):
+    """
+    mean vector of the tokens of every row, zero for rows without any.
+    """
+    length = np.asarray(bag.sum(axis=1)).ravel()
+    return (bag @ vectors) / np.maximum(length, 1)[:, None]
+
+
+def fit_embedding(strings, rows, codes, vocab, size=12, n_components=6):
+    """
+    train Word2Vec on the rows and a TruncatedSVD on the mean token
+    vector of every row. The SVD is linear, so the model is kept as the
+    projected vector of every known token.
+    return (known tokens, projection of shape (n_known, n_components))
     """
     from gensim.models.word2vec import Word2Vec
 
-    input_ = df[col].fillna('NA').apply(lambda x: str(x).split(' '))
-    model = Word2Vec(input_, size=12, min_count=2, iter=5, window=5, workers=4)
-    data_vec = []
-    for row in input_:
-        data_vec.append(base_embedding(row, model, size=12))
-    svdT = TruncatedSVD(n_components=6)
-    data_vec = svdT.fit_transform(data_vec)
-    column_names = []
-    for i in range(6):
-        column_names.append('embedding_{}_{}'.format(col, i))
-    data_vec = pd.DataFrame(data_vec, columns=column_names)
-    df = pd.concat([df, data_vec], axis=1)
+    sentences = [i.split(' ') for i in strings]
+    model = Word2Vec(sentences, size=size, min_count=2, iter=5, window=5, workers=4)
+    known = np.array([i in model.wv for i in vocab], dtype=bool)
+    vectors = np.zeros((known.sum(), size))
+    if known.any():
+        vectors[:] = model.wv[list(vocab[known])]
+    # token code -> row of vectors, -1 for tokens under min_count
+    index = np.where(known, np.cumsum(known) - 1, -1)
+    bag = bag_of_words(rows, index[codes], len(sentences), len(vectors))
+    svd = TruncatedSVD(n_components=n_components).fit(bag_mean(bag, vectors))
+    return vocab[known], vectors @ svd.components_.T
+
+
+@register_op(
+    FeatureType.EMBEDDING,
+    columns = lambda args: ['embedding_{}_{}'.format(args[0], i) for i in range(6)])
+def embedding(df, col, cache=None):
+    """
+    This is the tool for multi-categories embedding encode.
+    embedding for one single multi-categories column.
+
+    cache : optional FeatureCache, the fitted model of the column is
+    stored there and reused instead of training Word2Vec again.
+    """
+    strings, rows, codes, vocab = tokenize(df[col])
+    model = cache.get('model_embedding_' + col) if cache is not None else None
+    if model is None:
+        tokens, projection = fit_embedding(strings, rows, codes, vocab)
+        if cache is not None:
+            cache.put('model_embedding_' + col, {'tokens': tokens, 'projection': projection})
+    else:
+        tokens, projection = model['tokens'], model['projection']
+    # the bag of words mean and the SVD are one sparse product with the projection
+    index = pd.Index(tokens).get_indexer(vocab)
+    data_vec = bag_mean(bag_of_words(rows, index[codes], len(df), len(tokens)), projection)
+    for i in range(data_vec.shape[1]):
+        df['embedding_{}_{}'.format(col, i)] = data_vec[:, i]
     return df
 
 
@@ -180,35 +561,56 @@ def add_noise(series, noise_level):
 
 def add_smooth(series, p, a = 1):
     """
-    target encoding smooth
+    target encoding smooth, mean of series shrunk to prior p with weight a
     """
-    return (series.sum() + p / series.count() + a)
+    return (series.sum() + p * a) / (series.count() + a)
 
 
-def target(df, col, target_name='label'):
+@register_op(
+    FeatureType.TARGET,
+    key = lambda args: args,
+    columns = lambda args: ['target_{}'.format(args[0])])
+def target(df, col, target_name='label', n_splits=5, p=0.5, a=1, noise_level=0, keys=None):
     """
     target encoding  using 5 k-fold with smooth
 
+    Per fold sums and counts come from one bincount, the out of fold
+    stats of a train row are the totals minus its own fold. Rows without
+    target are encoded with the totals. Missing values of col are a
+    category of their own, unseen categories get the target mean.
+
     target_name : surpvised learning task pred target name, y.
+    p, a : smooth prior and its weight, see add_smooth.
+    noise_level : add_noise level on the train rows, 0 means no noise.
     """
-    df[col] = df[col].fillna('-9999999')
-    mean_of_target = df[target_name].mean()
-
-    kf = KFold(n_splits = 5, shuffle = True, random_state=2019) 
-    col_mean_name = "target_{}".format(col)
-    X = df[df[target_name].isnull() == False].reset_index(drop=True)
-    X_te = df[df[target_name].isnull()].reset_index(drop=True)
-    X.loc[:, col_mean_name] = np.nan
-    
-    for tr_ind, val_ind in kf.split(X):
-        X_tr, X_val = X.iloc[tr_ind], X.iloc[val_ind]
-        X.loc[df.index[val_ind], col_mean_name] = X_val[col].map(X_tr.groupby(col)[target_name].apply(lambda x: add_smooth(x, 0.5, 1)))
-
-    tr_agg =  X[[col, target_name]].groupby([col])[target_name].apply(lambda x: add_smooth(x, 0.5, 1)).reset_index()
-    tr_agg.columns = [col, col_mean_name]
-
-    X_te = X_te.merge(tr_agg, on = [col], how = 'left')
-    _s = np.array(pd.concat([X[col_mean_name], X_te[col_mean_name]]).fillna(mean_of_target))
-    df[col_mean_name] =  _s
+    key = (keys or KeyCache(df)).get([col])
+    n = key.n_groups + 1
+    codes = np.where(key.valid, key.codes, key.n_groups)
+    y = df[target_name].values.astype(float)
+    train = ~np.isnan(y)
+    mean_of_target = y[train].mean()
+
+    train_index = np.where(train)[0]
+    fold = np.zeros(len(train_index), dtype=np.int64)
+    kf = KFold(n_splits = n_splits, shuffle = True, random_state=2019) 
+    for k, (tr_ind, val_ind) in enumerate(kf.split(train_index)):
+        fold[val_ind] = k
+
+    train_codes, train_y = codes[train], y[train]
+    total_sum = np.bincount(train_codes, weights=train_y, minlength=n)
+    total_cnt = np.bincount(train_codes, minlength=n).astype(float)
+    fold_codes = fold * n + train_codes
+    fold_sum = np.bincount(fold_codes, weights=train_y, minlength=n_splits * n)
+    fold_cnt = np.bincount(fold_codes, minlength=n_splits * n)
+
+    sum_ = total_sum[codes]
+    cnt = total_cnt[codes]
+    sum_[train] -= fold_sum[fold_codes]
+    cnt[train] -= fold_cnt[fold_codes]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        _s = np.where(cnt > 0, (sum_ + p * a) / (cnt + a), mean_of_target)
+    if noise_level > 0:
+        _s[train] = add_noise(_s[train], noise_level)
+    df['target_{}'.format(col)] = _s
     return df
 
@@ -0,0 +1,96 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import json
+import hashlib
+import numpy as np
+
+# bump when the layout of a cache entry changes
+FORMAT_VERSION = 1
+
+
+def code_version():
+    """
+    short hash of FORMAT_VERSION and of the source of the operators, an
+    edit of fe_util.py starts a new cache instead of serving the columns
+    of the old code.
+    """
+    h = hashlib.md5(str(FORMAT_VERSION).encode('utf-8'))
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fe_util.py'), 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+class FeatureCache:
+    """
+    content-addressed on-disk store of generated feature columns.
+
+    Every feature name (e.g. count_C1) is stored once under
+    cache_dir/fingerprint-code_version/ as one .npy file per output column
+    plus a small json manifest, later trials memory-map the columns back.
+    """
+    def __init__(self, fingerprint, cache_dir='feature_cache'):
+        self.fingerprint = fingerprint
+        self.path = os.path.join(cache_dir, '{}-{}'.format(fingerprint, code_version()))
+        os.makedirs(self.path, exist_ok=True)
+
+
+    def _file(self, name, suffix):
+        return os.path.join(self.path, name + suffix)
+
+
+    def __contains__(self, name):
+        return os.path.exists(self._file(name, '.json'))
+
+
+    def get(self, name):
+        """
+        return {column: memory-mapped array} for a feature name, None if missing.
+        """
+        if name not in self:
+            return None
+        with open(self._file(name, '.json')) as f:
+            columns = json.load(f)
+        result = {}
+        for i, col in enumerate(columns):
+            result[col] = np.load(self._file('{}.{}'.format(name, i), '.npy'), mmap_mode='r')
+        return result
+
+
+    def put(self, name, frame):
+        """
+        store every column of frame under the feature name, frame can also
+        be a dict of arrays, e.g. the fitted model of an operator.
+        """
+        columns = [str(i) for i in frame.keys()]
+        for i, col in enumerate(frame.keys()):
+            _atomic_write(
+                self._file('{}.{}'.format(name, i), '.npy'),
+                lambda f, v=np.asarray(frame[col]): np.save(f, v, allow_pickle=False))
+        # manifest goes last, so a present manifest means a complete entry.
+        _atomic_write(self._file(name, '.json'), lambda f: f.write(json.dumps(columns).encode('utf-8')))
+
+
+def _atomic_write(file_name, writer):
+    """
+    write to a temp file then rename, concurrent trials never see partial files.
+    """
+    tmp_name = '{}.{}.tmp'.format(file_name, os.getpid())
+    with open(tmp_name, 'wb') as f:
+        writer(f)
+    os.replace(tmp_name, file_name)
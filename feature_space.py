@@ -0,0 +1,102 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import numpy as np
+
+from const import FeatureType, AGGREGATE_TYPE
+
+
+class FeatureSpace:
+    """
+    compact candidate feature space parsed from the search space json.
+
+    Every op is a block of integer arrays instead of a list of name
+    strings: the column indexes of each candidate (one row per candidate)
+    and, for aggregate, the index of its stat in AGGREGATE_TYPE. A
+    candidate is addressed by its global index, names are only decoded
+    for the sampled ones, so memory stays small on large grids.
+    """
+    def __init__(self, default_space):
+        self.columns = []
+        self.column_index = {}
+        # (op_name, cols int32 array (n, arity), stats int8 array (n,) or None)
+        self.blocks = []
+        for key in default_space.keys():
+            if key in [FeatureType.COUNT, FeatureType.TARGET, FeatureType.EMBEDDING]:
+                cols = self.index(default_space[key])[:, None]
+                self.blocks.append((key, cols, None))
+
+            elif key == FeatureType.CROSSCOUNT:
+                i, j = self.grid(default_space[key][0], default_space[key][1])
+                i, j = i.ravel(), j.ravel()
+                keep = i != j
+                i, j = i[keep], j[keep]
+                # a pair is named in sorted column name order, and only kept once
+                names = np.array(self.columns)
+                swap = names[i] > names[j]
+                i[swap], j[swap] = j[swap], i[swap]
+                _, first = np.unique(np.stack([i, j], axis=1), axis=0, return_index=True)
+                first.sort()
+                self.blocks.append((key, np.stack([i[first], j[first]], axis=1), None))
+
+            elif key == FeatureType.AGGREGATE:
+                i, j = self.grid(default_space[key][0], default_space[key][1])
+                n_stat = len(AGGREGATE_TYPE)
+                cols = np.repeat(np.stack([i.ravel(), j.ravel()], axis=1), n_stat, axis=0)
+                stats = np.tile(np.arange(n_stat, dtype=np.int8), i.size)
+                self.blocks.append((key, cols, stats))
+
+            elif key in [FeatureType.NUNIQUE, FeatureType.HISTSTAT]:
+                i, j = self.grid(default_space[key][0], default_space[key][1])
+                self.blocks.append((key, np.stack([i.ravel(), j.ravel()], axis=1), None))
+
+            else:
+                raise RuntimeError('feature ' + str(key) + ' Not supported now')
+        self.offsets = np.cumsum([0] + [len(cols) for _, cols, _ in self.blocks])
+
+
+    def index(self, names):
+        """
+        column indexes of names, new columns are appended to the vocabulary.
+        """
+        for i in names:
+            if i not in self.column_index:
+                self.column_index[i] = len(self.columns)
+                self.columns.append(i)
+        return np.array([self.column_index[i] for i in names], dtype=np.int32)
+
+
+    def grid(self, names1, names2):
+        return np.meshgrid(self.index(names1), self.index(names2), indexing='ij')
+
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+
+    def name(self, index):
+        """
+        decode the feature name of one candidate.
+        """
+        block = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        op_name, cols, stats = self.blocks[block]
+        row = index - self.offsets[block]
+        parts = [op_name]
+        if stats is not None:
+            parts.append(AGGREGATE_TYPE[stats[row]])
+        parts += [self.columns[i] for i in cols[row]]
+        return '_'.join(parts)
@@ -0,0 +1,73 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import base64
+import hashlib
+import numpy as np
+
+from fe_util import feature_columns
+
+
+def space_version(search_space):
+    """
+    short hash of a search space, an importance payload is only applied
+    to the candidates of the search space it was computed for.
+    """
+    return hashlib.md5(json.dumps(search_space, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def encode_array(array, dtype):
+    return base64.b64encode(np.ascontiguousarray(array, dtype=dtype).tobytes()).decode('ascii')
+
+
+def decode_array(text, dtype):
+    return np.frombuffer(base64.b64decode(text), dtype=dtype)
+
+
+def pack_importance(importance, params):
+    """
+    compact importance payload of a trial, instead of the importance frame.
+
+    A trial of sampled features sends their candidate indexes (int32) and
+    scores (float32, the sum of the scores of the columns a feature
+    generates). The first trial sends the scores of the raw columns by
+    name. The arrays go base64 encoded through the nni metric channel.
+    importance : get_fea_importance frame.
+    params : the trial parameters of the feature set.
+    """
+    # a model without any split has nan scores, see get_fea_importance
+    score = dict(zip(importance['feature_name'], np.nan_to_num(importance['feature_score'].values, nan=0.0)))
+    payload = {'version': params.get('space_version')}
+    if 'sample_index' in params:
+        value = [sum(score.get(j, 0) for j in feature_columns(i)) for i in params['sample_feature']]
+        payload['index'] = encode_array(params['sample_index'], np.int32)
+        payload['score'] = encode_array(value, np.float32)
+    else:
+        payload['columns'] = [str(i) for i in score.keys()]
+        payload['score'] = encode_array(list(score.values()), np.float32)
+    return payload
+
+
+def unpack_importance(payload):
+    """
+    return (version, raw column scores dict or None, candidate indexes, candidate scores)
+    """
+    score = decode_array(payload['score'], np.float32)
+    if 'columns' in payload:
+        return payload['version'], dict(zip(payload['columns'], score.tolist())), None, None
+    return payload['version'], None, decode_array(payload['index'], np.int32).astype(np.int64), score
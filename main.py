@@ -15,36 +15,83 @@
 # DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
 import nni
+import sys
 import logging
-import numpy as np
-import pandas as pd
-import json
-from fe_util import *
-from model import *
+import trial_worker
+from profiler import Profiler, write_log
 
 logger = logging.getLogger('auto-fe-examples')
 
+file_name = 'train.tiny.csv'
+target_name = 'Label'
+id_index = 'Id'
+cache_dir = 'feature_cache'
+dataset_cache_dir = 'dataset_cache'
+# processes generating the features of tables of fe_util.PARALLEL_MIN_ROWS rows or more
+n_workers = 1
+# rows per chunk to generate the features out of core from file_name, None
+# generates them on the loaded data, see fe_stream.name2feature_stream
+stream_chunksize = None
+# HyperLogLog precision of the streamed nunique features, None counts exactly
+nunique_precision = None
+# stage timings of every trial are appended here, see profile_summary.py
+profile_log = 'profile.jsonl'
+# keep the modules and the data loaded in a worker process between trials
+use_worker = True
+# concurrent trials of the worker, one process each
+worker_slots = 2
+# shared secret of the node workers, when the tuner dispatches the trials to nodes
+node_authkey = os.environ.get('AUTOFE_AUTHKEY', '')
+
+
+def load_data():
+    # pandas, lightgbm and the fe modules are imported by the worker only,
+    # a trial served by the worker just sends its parameters
+    from data_util import load_dataset, file_key
+    profiler = Profiler()
+    with profiler.stage('load'):
+        df = load_dataset(file_name, dataset_cache_dir)
+    # the feature caches are keyed by the source file (path, size, mtime),
+    # instead of hashing every row of df in every trial
+    fingerprint = file_key(os.path.expanduser(file_name), {})
+    return df, fingerprint, profiler.records
+
+
+def run_trial(data, RECEIVED_PARAMS, report=None):
+    from trial_util import run_batch
+
+    df, fingerprint, load_records = data
+    profiler = Profiler()
+    # the load is reported by the first trial on the data only
+    profiler.extend(load_records)
+    del load_records[:]
+    return run_batch(
+        df, RECEIVED_PARAMS, fingerprint, target_name, id_index, report = report, profiler = profiler,
+        cache_dir = cache_dir, dataset_cache_dir = dataset_cache_dir, n_workers = n_workers,
+        stream_file = file_name, stream_chunksize = stream_chunksize, nunique_precision = nunique_precision)
+
+
 if __name__ == '__main__':
-    file_name = 'train.tiny.csv'
-    target_name = 'Label'
-    id_index = 'Id'
-
-    # get parameters from tuner
-    RECEIVED_PARAMS = nni.get_next_parameter()
-    logger.info("Received params:\n", RECEIVED_PARAMS)
-    
-    # list is a column_name generate from tuner
-    df = pd.read_csv(file_name)
-    if 'sample_feature' in RECEIVED_PARAMS.keys():
-        sample_col = RECEIVED_PARAMS['sample_feature']
+    if '--worker' in sys.argv:
+        # python main.py --worker --node host:port serves the tuner dispatch as a node
+        node = sys.argv[sys.argv.index('--node') + 1] if '--node' in sys.argv else None
+        trial_worker.serve(
+            __file__, load_data, run_trial, data_files = [file_name], node = node, authkey = node_authkey,
+            slots = worker_slots)
     else:
-        sample_col = []
-    
-    # raw feaure + sample_feature
-    df = name2feature(df, sample_col, target_name)
-    feature_imp, val_score = lgb_model_train(df,  _epoch = 1000, target_name = target_name, id_index = id_index)
-    nni.report_final_result({
-        "default":val_score, 
-        "feature_importance":feature_imp
-    })
+        # get parameters from tuner
+        RECEIVED_PARAMS = nni.get_next_parameter()
+        logger.info("Received params:\n", RECEIVED_PARAMS)
+
+        profiler = Profiler()
+        with profiler.stage('trial'):
+            result = trial_worker.run(
+                __file__, load_data, run_trial, RECEIVED_PARAMS, nni.report_intermediate_result,
+                data_files = [file_name], use_worker = use_worker,
+                node = RECEIVED_PARAMS.get('node'), authkey = node_authkey)
+        result["profile"] += profiler.records
+        if profile_log:
+            write_log(profile_log, result["profile"], trial = nni.get_trial_id())
+        nni.report_final_result(result)
@@ -19,9 +19,17 @@ import numpy as np
 import pandas as pd 
 import lightgbm as lgb 
 import gc
+import os
+import json
+import hashlib
 from sklearn.preprocessing import LabelEncoder
 from sklearn.model_selection import StratifiedShuffleSplit
 from sklearn.metrics import roc_auc_score, roc_curve,log_loss
+from profiler import Profiler
+
+# stratified validation split of every trial
+VAL_SIZE = 0.15
+VAL_SEED = 1024
 
 
 def get_fea_importance(clf, feature_name):
@@ -41,51 +49,276 @@ def get_fea_importance(clf, feature_name):
     return importance_df
 
 
-def train_test_split(X, y, test_size, random_state=2018):
+def split_index(y, test_size, random_state=2018):
+    """
+    stratified train / test row positions.
+    """
     sss = list(StratifiedShuffleSplit(
-        n_splits=1, test_size=test_size, random_state=random_state).split(X, y))
-    X_train = np.take(X, sss[0][0], axis=0)
-    X_test = np.take(X, sss[0][1], axis=0)
-    y_train = np.take(y, sss[0][0], axis=0)
-    y_test = np.take(y, sss[0][1], axis=0)
+        n_splits=1, test_size=test_size, random_state=random_state).split(np.zeros(len(y)), y))
+    return sss[0][0], sss[0][1]
+
+
+def subsample_index(y, fraction, random_state=2019, min_rows=None):
+    """
+    sorted positions of a stratified fraction of the rows.
+
+    The fraction is raised so every class keeps min_rows rows (default
+    params_lgb min_data), a smaller sample could not be split at all.
+    """
+    min_rows = params_lgb['min_data'] if min_rows is None else min_rows
+    fraction = max(fraction, min_rows / max(np.unique(y, return_counts=True)[1].min(), 1))
+    if fraction >= 1:
+        return np.arange(len(y))
+    return np.sort(split_index(y, 1 - fraction, random_state)[0])
+
+
+def downsample_index(y, negative_rate, random_state=2020, min_rows=None):
+    """
+    sorted positions of all the positive rows and of a negative_rate
+    fraction of the negative ones, and their weights: the kept negatives
+    weigh 1 / negative_rate, so the label balance of y is kept. The rate
+    is raised so min_rows negatives are kept, like subsample_index.
+    """
+    min_rows = params_lgb['min_data'] if min_rows is None else min_rows
+    negative_rate = max(negative_rate, min_rows / max(np.sum(y <= 0), 1))
+    if negative_rate >= 1:
+        return np.arange(len(y)), None
+    keep = (y > 0) | (np.random.RandomState(random_state).random_sample(len(y)) < negative_rate)
+    index = np.flatnonzero(keep)
+    weight = np.where(y[index] > 0, 1.0, 1.0 / negative_rate)
+    return index, weight
+
+
+def report_callback(report, period=50):
+    """
+    lgb callback sending the validation auc to report every period rounds.
+    """
+    def _callback(env):
+        if (env.iteration + 1) % period == 0:
+            report(env.evaluation_result_list[0][2])
+    return _callback
+
+
+def train_test_split(X, y, test_size, random_state=2018):
+    train_index, test_index = split_index(y, test_size, random_state)
+    X_train = np.take(X, train_index, axis=0)
+    X_test = np.take(X, test_index, axis=0)
+    y_train = np.take(y, train_index, axis=0)
+    y_test = np.take(y, test_index, axis=0)
     return [X_train, X_test, y_train, y_test]
 
 
-def lgb_model_train( df, _epoch=1000, target_name='Label', id_index='Id'):
-    df = df.loc[df[target_name].isnull()==False]
-    feature_name = [i for i in df.columns if i not in [target_name, id_index]]
+def encode_features(df, feature_name):
+    """
+    label encode the string and categorical columns of df.
+    """
     for i in feature_name:
         if df[i].dtypes == 'object':
             if df[i].fillna('na').nunique() < 12:
                 df.loc[:,i] = df.loc[:,i].fillna('na').astype('category')
             else:
                 df.loc[:,i] = LabelEncoder().fit_transform(df.loc[:,i].fillna('na').astype(str))
-    params_lgb = {
-            "objective": "binary", 
-            "metric":"auc", 
-            'verbose': -1, 
-            "seed": 1024, 
-            'num_threads': 4,
-            'num_leaves':64, 
-            'learning_rate': 0.05,
-            'min_data': 200, 
-            'bagging_fraction': 0.5,
-            'feature_fraction': 0.5,
-            'max_depth': -1 ,
-    }
-    X_train, X_val, y_train, y_val = train_test_split(df[feature_name], df[target_name].values, 0.15, 1024)
-    del df
-    gc.collect()
+        elif str(df[i].dtypes) == 'category':
+            # typed dataset columns, the codes of the sorted dictionary are already label encoded
+            if df[i].nunique(dropna=False) < 12:
+                df[i] = df[i].astype(object).fillna('na').astype('category')
+            else:
+                df[i] = df[i].cat.codes
+    return df
+
+
+params_lgb = {
+        "objective": "binary", 
+        "metric":"auc", 
+        'verbose': -1, 
+        "seed": 1024, 
+        'num_threads': 4,
+        'num_leaves':64, 
+        'learning_rate': 0.05,
+        'min_data': 200, 
+        'bagging_fraction': 0.5,
+        'feature_fraction': 0.5,
+        'max_depth': -1 ,
+}
 
-    lgb_train = lgb.Dataset(X_train, y_train)
-    lgb_val = lgb.Dataset(X_val, y_val, reference=lgb_train)
+
+class RawDatasetCache:
+    """
+    binned lgb.Dataset of the raw columns in LightGBM binary format.
+
+    The raw columns and the stratified train / validation split are the
+    same in every trial, so they are label encoded and binned once. Later
+    trials load the binary files and only bin their generated columns.
+    The files are keyed by the data fingerprint, the raw columns, the
+    label and id columns and the validation split, a change of any of them
+    bins the raw columns again.
+    """
+    def __init__(self, fingerprint, raw_columns, cache_dir='dataset_cache', target_name='Label', id_index='Id'):
+        self.raw_columns = list(raw_columns)
+        h = hashlib.md5()
+        h.update(json.dumps([
+            fingerprint, [str(i) for i in self.raw_columns], str(target_name), str(id_index),
+            VAL_SIZE, VAL_SEED]).encode('utf-8'))
+        self.path = os.path.join(cache_dir, 'lgb_' + h.hexdigest())
+
+
+    def load(self, build):
+        """
+        return constructed (train, val) Datasets, build() creates them when missing.
+        """
+        train_file = os.path.join(self.path, 'train.bin')
+        val_file = os.path.join(self.path, 'val.bin')
+        if os.path.exists(train_file) and os.path.exists(val_file):
+            lgb_train = lgb.Dataset(train_file, params={'verbose': -1}).construct()
+            lgb_val = lgb.Dataset(val_file, reference=lgb_train, params={'verbose': -1}).construct()
+            return lgb_train, lgb_val
+
+        lgb_train, lgb_val = build()
+        lgb_train.construct()
+        lgb_val.construct()
+        os.makedirs(self.path, exist_ok=True)
+        # val goes first, a present train.bin means both are complete
+        for dataset, file_name in [(lgb_val, val_file), (lgb_train, train_file)]:
+            tmp_name = '{}.{}.tmp'.format(file_name, os.getpid())
+            dataset.save_binary(tmp_name)
+            os.replace(tmp_name, file_name)
+        return lgb_train, lgb_val
+
+
+def lgb_model_train( df, _epoch=1000, target_name='Label', id_index='Id', raw_cache=None, row_fraction=1.0, report=None, profiler=None, model_file=None, negative_rate=1.0, features=None):
+    """
+    raw_cache : optional RawDatasetCache, the raw columns come from its
+    binned Dataset and only the other columns are binned in this call.
+    row_fraction : stratified fraction of the train rows to fit on, the
+    validation rows are kept whole so the auc stays comparable.
+    negative_rate : fraction of the negative train rows to fit on, after
+    row_fraction, the kept negatives are reweighted. A cheap screening of
+    skewed labels, e.g. click logs.
+    report : optional function called with the validation auc every 50
+    rounds, e.g. nni.report_intermediate_result.
+    profiler : optional Profiler recording the encode, dataset, train and
+    evaluate stages.
+    model_file : optional path the booster of the best iteration is saved to,
+    e.g. for fe_transform.fit_pipeline.
+    features : optional (columns, 2-D array) of generated numeric columns,
+    one array row per row of df, e.g. fe_util.ColumnBuffer.select. With
+    raw_cache the train and val rows go from the array to lgb.Dataset
+    without a dataframe copy.
+    """
+    profiler = profiler or Profiler()
+    callbacks = [report_callback(report)] if report is not None else None
+    labeled = df[target_name].notnull().values
+    df = df.loc[labeled]
+    if raw_cache is not None:
+        feature_name = [i for i in df.columns if i not in [target_name, id_index]]
+        return lgb_model_train_cached(
+            df, feature_name, _epoch, target_name, raw_cache, row_fraction, callbacks, profiler, model_file, negative_rate,
+            features, np.flatnonzero(labeled))
+    if features is not None:
+        columns, values = features
+        df = df.assign(**dict((col, values[labeled, i]) for i, col in enumerate(columns)))
+    feature_name = [i for i in df.columns if i not in [target_name, id_index]]
+
+    with profiler.stage('encode'):
+        df = encode_features(df, feature_name)
+        X_train, X_val, y_train, y_val = train_test_split(df[feature_name], df[target_name].values, VAL_SIZE, VAL_SEED)
+        if row_fraction < 1:
+            keep = subsample_index(y_train, row_fraction)
+            X_train, y_train = np.take(X_train, keep, axis=0), np.take(y_train, keep, axis=0)
+        weight = None
+        if negative_rate < 1:
+            keep, weight = downsample_index(y_train, negative_rate)
+            X_train, y_train = np.take(X_train, keep, axis=0), np.take(y_train, keep, axis=0)
+        del df
+        gc.collect()
+
+    with profiler.stage('dataset'):
+        # built here with the training params so its time is not counted as training
+        lgb_train = lgb.Dataset(X_train, y_train, weight=weight, params=params_lgb).construct()
+        lgb_val = lgb.Dataset(X_val, y_val, reference=lgb_train, params=params_lgb).construct()
 
     #del X_train, X_val, y_train, y_val
     gc.collect()
-    clf = lgb.train(
-        params_lgb, lgb_train, valid_sets=lgb_val, valid_names='eval', 
-        verbose_eval=50, early_stopping_rounds=100, num_boost_round=_epoch)
+    with profiler.stage('train', features = len(feature_name), row_fraction = row_fraction, negative_rate = negative_rate):
+        clf = lgb.train(
+            params_lgb, lgb_train, valid_sets=lgb_val, valid_names='eval', 
+            verbose_eval=50, early_stopping_rounds=100, num_boost_round=_epoch, callbacks=callbacks)
+    profiler.records[-1]['rounds'] = clf.current_iteration()
+
+    with profiler.stage('evaluate'):
+        fea_importance_now = get_fea_importance(clf, feature_name)
+        val_auc = roc_auc_score(y_val,  clf.predict(X_val, num_iteration=clf.best_iteration))
+    if model_file is not None:
+        clf.save_model(model_file, num_iteration=clf.best_iteration)
+    return fea_importance_now, val_auc
+
+
+def lgb_model_train_cached(df, feature_name, _epoch, target_name, raw_cache, row_fraction=1.0, callbacks=None, profiler=None, model_file=None, negative_rate=1.0, features=None, rows=None):
+    """
+    rows : positions of the rows of df in the array of features.
+    """
+    raw_feature = [i for i in feature_name if i in raw_cache.raw_columns]
+    new_feature = [i for i in feature_name if i not in raw_cache.raw_columns]
+    y = df[target_name].values
+    train_index, val_index = split_index(y, VAL_SIZE, VAL_SEED)
+
+    def build():
+        X = encode_features(df[raw_feature].copy(), raw_feature)
+        lgb_train = lgb.Dataset(X.iloc[train_index], y[train_index])
+        lgb_val = lgb.Dataset(X.iloc[val_index], y[val_index], reference=lgb_train)
+        return lgb_train, lgb_val
+
+    profiler = profiler or Profiler()
+    with profiler.stage('dataset', raw = True):
+        lgb_train, lgb_val = raw_cache.load(build)
+        keep, weight = np.arange(len(train_index)), None
+        if row_fraction < 1:
+            keep = subsample_index(y[train_index], row_fraction)
+        if negative_rate < 1:
+            down, weight = downsample_index(y[train_index[keep]], negative_rate)
+            keep = keep[down]
+        if len(keep) < len(train_index):
+            lgb_train = lgb_train.subset(keep).construct()
+            # a subset shares the bin mappers of its parent, lgb_val stays valid for it
+            lgb_val.reference = lgb_train
+            train_index = train_index[keep]
+        if weight is not None:
+            lgb_train.set_weight(weight)
+    # bundles of the new columns are not kept aligned by add_features_from,
+    # lgb.train then rejects lgb_val for different bin mappers
+    new_params = {'verbose': -1, 'enable_bundle': False}
+    if len(new_feature) > 0:
+        with profiler.stage('encode'):
+            X = encode_features(df[new_feature].copy(), new_feature)
+        with profiler.stage('dataset'):
+            new_train = lgb.Dataset(X.iloc[train_index], params=new_params).construct()
+            new_val = lgb.Dataset(X.iloc[val_index], reference=new_train, params=new_params).construct()
+            lgb_train.add_features_from(new_train)
+            lgb_val.add_features_from(new_val)
+    if features is not None and len(features[0]) > 0:
+        with profiler.stage('dataset'):
+            columns, values = features
+            # the rows are gathered straight from the array in the split order, lgb
+            # subset would sort them and misalign them with the raw Dataset
+            new_train = lgb.Dataset(values[rows[train_index]], feature_name=columns, params=new_params).construct()
+            new_val = lgb.Dataset(
+                values[rows[val_index]], feature_name=columns, reference=new_train, params=new_params).construct()
+            lgb_train.add_features_from(new_train)
+            lgb_val.add_features_from(new_val)
+        feature_name = feature_name + columns
+    del df
+    gc.collect()
+
+    with profiler.stage('train', features = len(feature_name), row_fraction = row_fraction, negative_rate = negative_rate):
+        clf = lgb.train(
+            params_lgb, lgb_train, valid_sets=lgb_val, valid_names='eval', 
+            verbose_eval=50, early_stopping_rounds=100, num_boost_round=_epoch, callbacks=callbacks)
+    profiler.records[-1]['rounds'] = clf.current_iteration()
 
-    fea_importance_now = get_fea_importance(clf, feature_name)
-    val_auc = roc_auc_score(y_val,  clf.predict(X_val, num_iteration=clf.best_iteration))
-    return fea_importance_now, val_auc
\ No newline at end of file
+    fea_importance_now = get_fea_importance(clf, clf.feature_name())
+    # the binned validation set has no raw rows to predict on, the auc of
+    # the best iteration is the same as roc_auc_score on its predictions
+    val_auc = clf.best_score['eval']['auc']
+    if model_file is not None:
+        clf.save_model(model_file, num_iteration=clf.best_iteration)
+    return fea_importance_now, val_auc
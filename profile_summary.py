@@ -0,0 +1,78 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import argparse
+from collections import OrderedDict
+
+from profiler import read_log
+
+GROUP_BY = OrderedDict([
+    ('stage', lambda r: [r['stage']]),
+    ('op', lambda r: [r['op']] if 'op' in r else []),
+    # an operator call is counted once for every raw column it reads
+    ('column', lambda r: r.get('columns', [])),
+])
+
+
+def summarize(records, by='stage'):
+    """
+    return [(key, {'n', 'wall', 'cpu', 'mean_wall', 'max_rss', 'max_peak_rss'})]
+    sorted by total wall time.
+    """
+    result = {}
+    for record in records:
+        for key in GROUP_BY[by](record):
+            row = result.setdefault(key, {'n': 0, 'wall': 0.0, 'cpu': 0.0, 'max_rss': None, 'max_peak_rss': None})
+            row['n'] += 1
+            row['wall'] += record['wall']
+            row['cpu'] += record['cpu']
+            for name, field in [('max_rss', 'rss'), ('max_peak_rss', 'peak_rss')]:
+                if record.get(field) is not None:
+                    row[name] = max(row[name] or 0, record[field])
+    for row in result.values():
+        row['mean_wall'] = row['wall'] / row['n']
+    return sorted(result.items(), key=lambda x: x[1]['wall'], reverse=True)
+
+
+def _mb(value):
+    return '-' if value is None else '{:.1f}'.format(value / 2 ** 20)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='aggregate the trial profiles of an experiment, e.g. python profile_summary.py profile.jsonl --by op')
+    parser.add_argument('logs', nargs='+', help='profile JSONL files')
+    parser.add_argument('--by', choices=list(GROUP_BY), default='stage')
+    parser.add_argument('--top', type=int, default=30)
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args()
+
+    rows = summarize(read_log(args.logs), args.by)[:args.top]
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print('{:<32}{:>8}{:>12}{:>12}{:>12}{:>10}{:>10}'.format(
+        args.by, 'n', 'wall s', 'mean s', 'cpu s', 'rss MB', 'peak MB'))
+    for key, row in rows:
+        print('{:<32}{:>8}{:>12.3f}{:>12.4f}{:>12.3f}{:>10}{:>10}'.format(
+            str(key)[:31], row['n'], row['wall'], row['mean_wall'], row['cpu'],
+            _mb(row['max_rss']), _mb(row['max_peak_rss'])))
+
+
+if __name__ == '__main__':
+    main()
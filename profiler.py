@@ -0,0 +1,122 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+
+def current_rss():
+    """
+    resident set size of this process in bytes, None when unknown.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss():
+    """
+    high-water mark of the resident set size in bytes, None when unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _delta(after, before):
+    if after is None or before is None:
+        return None
+    return after - before
+
+
+class Profiler:
+    """
+    wall time, cpu time and memory of the stages of one trial.
+
+    Every stage appends a record {'stage', 'wall', 'cpu', 'rss', 'peak_rss',
+    **tags}: wall and process cpu seconds, the change of the resident set
+    size and the growth of its high-water mark in bytes during the stage.
+    The cpu time and the memory are the ones of the whole process, so
+    concurrent trials in one worker see each other's.
+    """
+    def __init__(self, **tags):
+        self.tags = tags
+        self.records = []
+
+
+    @contextmanager
+    def stage(self, name, **tags):
+        wall, cpu = time.perf_counter(), time.process_time()
+        rss, peak = current_rss(), peak_rss()
+        try:
+            yield
+        finally:
+            record = dict(self.tags)
+            record.update({
+                'stage': name,
+                'wall': time.perf_counter() - wall,
+                'cpu': time.process_time() - cpu,
+                'rss': _delta(current_rss(), rss),
+                'peak_rss': _delta(peak_rss(), peak),
+            })
+            record.update(tags)
+            self.records.append(record)
+
+
+    def extend(self, records, **tags):
+        """
+        add the records of an other profiler, e.g. one of a worker process.
+        """
+        for record in records:
+            record = dict(self.tags, **record)
+            record.update(tags)
+            self.records.append(record)
+
+
+def write_log(path, records, **tags):
+    """
+    append records to the JSONL file at path, one line per record.
+    """
+    lines = []
+    for record in records:
+        record = dict(record)
+        record.update(tags)
+        lines.append(json.dumps(record) + '\n')
+    # a single append keeps the lines of concurrent trials whole
+    with open(path, 'a') as f:
+        f.write(''.join(lines))
+
+
+def read_log(paths):
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return records
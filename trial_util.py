@@ -0,0 +1,102 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from fe_util import name2feature, feature_columns, ColumnBuffer
+from model import lgb_model_train, RawDatasetCache
+from feature_cache import FeatureCache
+from importance import pack_importance
+from profiler import Profiler
+
+
+def unpack_batch(params):
+    """
+    the feature sets of a trial, several when the tuner batches them
+    (batch_size > 1). A set may carry a fidelity and a negative_rate.
+    """
+    return params.get('sample_batch', [params])
+
+
+def pack_batch(results):
+    """
+    final result of a trial from the results of its feature sets, in
+    the order of unpack_batch.
+    """
+    if len(results) == 1:
+        return results[0]
+    return {
+        "default":max(i["default"] for i in results),
+        "batch":results
+    }
+
+
+def run_batch(df, RECEIVED_PARAMS, fingerprint, target_name='Label', id_index='Id', report=None,
+              profiler=None, cache_dir='feature_cache', dataset_cache_dir='dataset_cache', n_workers=1,
+              stream_file=None, stream_chunksize=None, nunique_precision=None):
+    """
+    generate the features of a trial on df and train one model per
+    feature set, the body of the run_trial of every trial script.
+
+    fingerprint : key of df in the feature and dataset caches, e.g. the
+    data_util.file_key of its source file.
+    report : called with the intermediate results of a single feature set.
+    profiler : Profiler the stage timings are added to.
+    stream_file, stream_chunksize : generate the features out of core from
+    stream_file, see fe_stream.stream_into.
+    return the final result, with the stage timings under "profile".
+    """
+    if profiler is None:
+        profiler = Profiler()
+    # a batched trial evaluates several feature sets
+    batch = unpack_batch(RECEIVED_PARAMS)
+    sample_col = []
+    for params in batch:
+        sample_col += [i for i in params.get('sample_feature', []) if i not in sample_col]
+
+    # raw feaure + the union of the sample_feature, generated once
+    raw_col = list(df.columns)
+    cache = FeatureCache(fingerprint, cache_dir)
+    raw_cache = RawDatasetCache(fingerprint, raw_col, dataset_cache_dir, target_name, id_index)
+    # the worker keeps df for the next trials, the features go to one preallocated buffer
+    buffer = ColumnBuffer(df, [j for i in sample_col for j in feature_columns(i)])
+    todo = sample_col
+    if stream_file and stream_chunksize:
+        # streamed features bypass the feature cache, target and embedding are left to name2feature
+        from fe_stream import stream_into
+        with profiler.stage('stream', chunksize = stream_chunksize):
+            todo = stream_into(buffer, stream_file, sample_col, stream_chunksize, nunique_precision)
+    buffer = name2feature(buffer, todo, target_name, cache = cache, n_workers = n_workers, profiler = profiler)
+
+    results = []
+    for index, params in enumerate(batch):
+        # successive halving: a fraction of the train rows and of the boosting rounds
+        fidelity = params.get('fidelity', 1.0)
+        columns = [j for i in params.get('sample_feature', []) for j in feature_columns(i)]
+        model_profiler = Profiler(set = index)
+        feature_imp, val_score = lgb_model_train(
+            df,  _epoch = max(int(1000 * fidelity), 100), target_name = target_name, id_index = id_index,
+            raw_cache = raw_cache, row_fraction = fidelity, negative_rate = params.get('negative_rate', 1.0),
+            report = report if len(batch) == 1 else None, profiler = model_profiler,
+            features = buffer.select(columns))
+        profiler.extend(model_profiler.records)
+        results.append({
+            "default":val_score,
+            "importance":pack_importance(feature_imp, params)
+        })
+
+    result = pack_batch(results)
+    result["profile"] = profiler.records
+    return result
@@ -0,0 +1,274 @@
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import sys
+import glob
+import time
+import signal
+import hashlib
+import logging
+import tempfile
+import threading
+import traceback
+import subprocess
+import multiprocessing
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+logger = logging.getLogger('autofe-worker')
+
+
+def worker_key(script, data_files=()):
+    """
+    md5 of the path and mtime of the trial script, of the repo modules and
+    of the data files, a new key starts a new worker after any edit.
+    """
+    repo = os.path.dirname(os.path.abspath(__file__))
+    files = [script] + sorted(glob.glob(os.path.join(repo, '*.py'))) + list(data_files)
+    h = hashlib.md5()
+    for name in files:
+        name = os.path.abspath(os.path.expanduser(name))
+        h.update(name.encode('utf-8'))
+        if os.path.exists(name):
+            h.update(str(os.stat(name).st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+
+def worker_address(key):
+    if sys.platform == 'win32':
+        return r'\\.\pipe\autofe-' + key
+    return os.path.join(tempfile.gettempdir(), 'autofe-{}.sock'.format(key))
+
+
+def node_address(node):
+    """
+    'host:port' of a node worker -> (host, port).
+    """
+    host, port = node.rsplit(':', 1)
+    return host, int(port)
+
+
+def own_socket(address):
+    """
+    True unless address is a local socket file of an other user, whose
+    worker could send anything to be unpickled here.
+    """
+    if not isinstance(address, str) or sys.platform == 'win32':
+        return True
+    try:
+        return os.stat(address).st_uid == os.getuid()
+    except OSError:
+        return False
+
+
+def listen(address, slots, key):
+    """
+    Listener on address, a local socket file is readable and writable by
+    this user only: the key of a local worker is derived from public paths.
+    """
+    mask = os.umask(0o177)
+    try:
+        return Listener(address, backlog=slots, authkey=key.encode('utf-8'))
+    finally:
+        os.umask(mask)
+
+
+def submit(address, key, params, report=None):
+    """
+    run params on the worker listening at address.
+
+    report is called with every intermediate result of the trial. return
+    the final result, None when no worker is listening.
+    """
+    if not own_socket(address):
+        return None
+    try:
+        conn = Client(address, authkey=key.encode('utf-8'))
+    except (OSError, EOFError, AuthenticationError):
+        return None
+    with conn:
+        conn.send(params)
+        while True:
+            kind, value = conn.recv()
+            if kind == 'intermediate':
+                if report is not None:
+                    report(value)
+            elif kind == 'final':
+                return value
+            else:
+                raise RuntimeError('Trial worker failed:\n' + value)
+
+
+def spawn(script):
+    """
+    start `python script --worker` detached from this trial.
+    """
+    # the worker must not pick up the nni trial of the process starting it
+    env = dict((k, v) for k, v in os.environ.items() if not k.startswith('NNI_'))
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(script), '--worker'], env=env,
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True)
+
+
+def run(script, load, trial, params, report=None, data_files=(), use_worker=True, node=None, authkey=''):
+    """
+    run one trial, on the warm worker of script when one is up.
+
+    load() returns the data kept by the worker, trial(data, params, report)
+    returns the final result. Without a worker the trial runs in this
+    process and a worker is started for the next trials.
+    node : optional 'host:port' of the node worker picked by the tuner, the
+    trial runs here when the node is down.
+    """
+    if node is not None:
+        result = submit(node_address(node), authkey, params, report)
+        if result is not None:
+            return result
+        logger.warning('node %s is down, the trial runs locally', node)
+    if use_worker:
+        key = worker_key(script, data_files)
+        result = submit(worker_address(key), key, params, report)
+        if result is not None:
+            return result
+        spawn(script)
+    return trial(load(), params, report)
+
+
+def serve(script, load, trial, data_files=(), idle_timeout=600, node=None, authkey='', slots=2):
+    """
+    keep load() in memory and run the trials submitted by the clients.
+    Exit after idle_timeout seconds without a trial.
+
+    slots : concurrent trials, every slot is a process forked after load()
+    that accepts and runs one trial at a time, so the trials do not share
+    a GIL and no process forks while running trial threads. The data
+    pages are shared copy on write. Windows runs one trial at a time.
+    node : optional 'host:port', serve the trials of the tuner dispatch on
+    this tcp address instead of the local ones, with the shared authkey
+    and no idle exit. The results are tagged with the node.
+    """
+    if node is not None:
+        if not authkey:
+            raise RuntimeError('A node worker needs an authkey')
+        key, address, idle_timeout = authkey, node_address(node), None
+    else:
+        key = worker_key(script, data_files)
+        address = worker_address(key)
+    data = load()
+    try:
+        listener = listen(address, slots, key)
+    except OSError:
+        if node is not None:
+            raise
+        if submit(address, key, None) is not None or sys.platform == 'win32':
+            # an other worker of the same key is up
+            return
+        # socket file left over by a killed worker
+        os.unlink(address)
+        listener = listen(address, slots, key)
+    # shared by the slot processes
+    forking = hasattr(os, 'fork')
+    context = multiprocessing.get_context('fork' if forking else None)
+    lock = context.Lock()
+    # 1 while the slot runs a trial
+    busy = context.Array('i', slots, lock=False)
+    last = context.Value('d', time.time(), lock=False)
+
+    def handle(conn, slot):
+        with conn:
+            try:
+                params = conn.recv()
+                if params is None:
+                    conn.send(('final', 'ping'))
+                    return
+                result = trial(data, params, lambda x: conn.send(('intermediate', x)))
+                if node is not None and isinstance(result, dict):
+                    result['node'] = node
+                conn.send(('final', result))
+            except Exception:
+                logger.exception('trial failed')
+                try:
+                    conn.send(('error', traceback.format_exc()))
+                except OSError:
+                    pass
+            finally:
+                with lock:
+                    busy[slot] = 0
+                    last.value = time.time()
+
+    def serve_slot(slot):
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # a failed handshake, e.g. a client with an other key
+                continue
+            with lock:
+                busy[slot] = 1
+                last.value = time.time()
+            handle(conn, slot)
+
+    def idle():
+        with lock:
+            return idle_timeout is not None and sum(busy) == 0 and time.time() - last.value > idle_timeout
+
+    if not forking:
+        def watchdog():
+            while not idle():
+                time.sleep(min(idle_timeout, 10))
+            listener.close()
+            os._exit(0)
+
+        if idle_timeout is not None:
+            threading.Thread(target=watchdog, daemon=True).start()
+        serve_slot(0)
+
+    children = {}
+
+    def fork_slot(slot):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                serve_slot(slot)
+            finally:
+                os._exit(1)
+        children[pid] = slot
+
+    def stop(*args):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        listener.close()
+        os._exit(0)
+
+    # this process only watches the slots, it starts no thread so forking a new slot is safe
+    signal.signal(signal.SIGTERM, stop)
+    for slot in range(slots):
+        fork_slot(slot)
+    while not idle():
+        time.sleep(min(idle_timeout or 10, 10))
+        for pid in list(children):
+            if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                logger.warning('trial slot %d died, starting a new one', pid)
+                slot = children.pop(pid)
+                with lock:
+                    busy[slot] = 0
+                    last.value = time.time()
+                fork_slot(slot)
+    stop()